@@ -1,14 +1,15 @@
 # ##################### IMPORTS ####################
 
 import argparse
+import importlib.util
 import pathlib
 import numpy as np
 import json
 from datetime import datetime
-from netCDF4 import Dataset
 import os
 import sys
 import utils.fig_utils as utils
+import utils.manifest_utils as manifest_utils
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -60,134 +61,160 @@ JOSS_parser.add_argument(
     default=None,
     help="Path to the input folder containing the data files",
 )
-# Execute the parse_args() method
-args = JOSS_parser.parse_args()
-
-if args.date:
-    try:
-        export_date = datetime.strptime(args.date.strip(), "%d/%m/%Y")
-    except Exception:
-        JOSS_parser.error("Bad date format, see --help for further information")
-else:
-    export_date = args.date
-
-# check if there is at least one action requested
-if args.standard is None and args.list is None and args.date is None:
-    JOSS_parser.error("No action requested, see --help to further information")
-
-if args.standard is not None and args.list is not None:
-    JOSS_parser.error("Invalid action requested, see --help to further information")
-
-if args.standard is not None and args.date is not None:
-    JOSS_parser.error("Invalid action requested, see --help to further information")
-
-if args.date is not None and args.list is not None:
-    JOSS_parser.error("Invalid action requested, see --help to further information")
-
-# ##################### SCRIPT #####################
-
-
-path_input = pathlib.Path(args.input) if args.input else pathlib.Path.cwd().joinpath("input")
-path_input_support = path_input.joinpath("support")
-
-path_output = path_input.joinpath("output")
-path_output_fig = path_output.joinpath("figures")
-path_input_data = path_output.joinpath("netCDF")
-
-
-# reading auxiliar data
-with open(path_input_support.joinpath("variables_info.json"), "r") as xfile:
-    variables_info_file = xfile.read()
-variables_info = json.loads(variables_info_file)
-
-with open(path_input_support.joinpath("netCDF_info_ARM.json"), "r") as xfile:
-    netCDF_info_file = xfile.read()
-netCDF_info = json.loads(netCDF_info_file)
-
-# reading all file names in folder or list
-EXT = ".nc"
-if args.standard:
-    print("Executing script in standard mode")
-    print("")
-    files = [
-        path_input_data.joinpath(file)
-        for file in os.listdir(path_input_data)
-        if file.endswith(EXT)
-    ]
-elif args.list:
-    print("Executing script in list mode")
-    print("")
-    files = np.loadtxt(path_input_support.joinpath("files_figures.txt"), dtype=str)
-    if len(files.shape) == 0:
-        files = files.reshape(1)
-    files = [path_input_data.joinpath(file) for file in files]
-elif args.date:
-    print("Executing script in date mode")
-    print("")
-    files = [
-        path_input_data.joinpath(file)
-        for file in os.listdir(path_input_data)
-        if file.endswith(EXT)
-    ]
-    #find the date from export_date in the file name considering the format YYYYMMDD in the file name:
-    files = [file for file in files if export_date.strftime("%Y%m%d") in file.name]
-else:
-    print("ERRO. please, check if the arguments are rights")
-    quit()
-
-# check if there is at least one file to process
-if len(files) == 0:
-    print("ERRO. No file to process")
-    quit()
-
-if args.png:
-    print("Executing script in png mode. Only PNG files are included in the output")
-
-for file in files:
-    print("Generating figures for file {}".format(file.name))
-    output_folder = path_output_fig.joinpath(str(file.name)[:-3])
-    pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
-
-    file_data = Dataset(file, "r")
-    time_index_file_data = [
-        datetime.utcfromtimestamp(x)
-        for x in file_data["time_offset"][:] + file_data["base_time"][:]
-    ]
-
-    fig_metadata = {"disdrometer": "RD-80", "site": "Atto-Campina"}
-
-    list_variables_1D = ["rain_rate", "radar_reflectivity", "liq_water"]
-
-    for var in list_variables_1D:
-        print("\tFigure for variable {}".format(var))
-        #convert missing values to NaN
-        var_data = np.array(file_data[var][:])
-        missing_value = file_data[var].missing_value
-        var_data[var_data == missing_value] = np.nan
-        utils.gen_fig_1D(
-            var_data,
-            time_index_file_data,
-            netCDF_info["variables"][var]["short_name"],
-            netCDF_info["variables"][var]["units"],
-            fig_metadata,
-            output_folder,
-            args.png,
-        )
+JOSS_parser.add_argument(
+    "-j",
+    "--jobs",
+    action="store",
+    type=int,
+    default=None,
+    help="Number of worker processes generating the figures of the files, each one with its own PNG renderer (default: serially)",
+)
+JOSS_parser.add_argument(
+    "--skip-unchanged",
+    action="store_true",
+    default=None,
+    help="Do not generate again the figures of the files whose content, json files, figure code and options did not change since their figures were generated (see output/figures/manifest.json)",
+)
+JOSS_parser.add_argument(
+    "--png-backend",
+    action="store",
+    choices=utils.PNG_BACKENDS,
+    default="kaleido",
+    help="Renderer of the PNG files: kaleido (default, one renderer process for the whole run, exporting in a background thread) or matplotlib (faster quicklook drawn with matplotlib, needs matplotlib installed)",
+)
+
 
-    if not args.png:
-        print("\tFigure for variable {}".format("Rain Rate and NDropxDi"))
-        rain_data = np.array(file_data['rain_rate'][:])
-        missing_value = file_data['rain_rate'].missing_value
-        rain_data[rain_data == missing_value] = np.nan
-        nd_data = np.array(file_data['num_drop_density'][:])
-        missing_value = file_data['num_drop_density'].missing_value
-        nd_data[nd_data == missing_value] = np.nan
-
-        utils.gen_fig_NDropxDi(
-            time_index_file_data,
-            rain_data,
-            variables_info["drop_mean_diam"],
-            nd_data,
-            fig_metadata,
-            output_folder,
+def main():
+
+    # Execute the parse_args() method
+    args = JOSS_parser.parse_args()
+
+    if args.date:
+        try:
+            export_date = datetime.strptime(args.date.strip(), "%d/%m/%Y")
+        except Exception:
+            JOSS_parser.error("Bad date format, see --help for further information")
+    else:
+        export_date = args.date
+
+    # check if there is at least one action requested
+    if args.standard is None and args.list is None and args.date is None:
+        JOSS_parser.error("No action requested, see --help to further information")
+
+    if args.standard is not None and args.list is not None:
+        JOSS_parser.error("Invalid action requested, see --help to further information")
+
+    if args.standard is not None and args.date is not None:
+        JOSS_parser.error("Invalid action requested, see --help to further information")
+
+    if args.date is not None and args.list is not None:
+        JOSS_parser.error("Invalid action requested, see --help to further information")
+
+    if args.png_backend == "matplotlib" and importlib.util.find_spec("matplotlib") is None:
+        JOSS_parser.error("--png-backend matplotlib needs matplotlib, install it with pip install matplotlib")
+
+    # ##################### SCRIPT #####################
+
+
+    path_input = pathlib.Path(args.input) if args.input else pathlib.Path.cwd().joinpath("input")
+    path_input_support = path_input.joinpath("support")
+
+    path_output = path_input.joinpath("output")
+    path_output_fig = path_output.joinpath("figures")
+    path_input_data = path_output.joinpath("netCDF")
+
+
+    # reading auxiliar data
+    with open(path_input_support.joinpath("variables_info.json"), "r") as xfile:
+        variables_info_file = xfile.read()
+    variables_info = json.loads(variables_info_file)
+
+    with open(path_input_support.joinpath("netCDF_info_ARM.json"), "r") as xfile:
+        netCDF_info_file = xfile.read()
+    netCDF_info = json.loads(netCDF_info_file)
+
+    # reading all file names in folder or list
+    EXT = ".nc"
+    if args.standard:
+        print("Executing script in standard mode")
+        print("")
+        files = [
+            path_input_data.joinpath(file)
+            for file in os.listdir(path_input_data)
+            if file.endswith(EXT)
+        ]
+    elif args.list:
+        print("Executing script in list mode")
+        print("")
+        files = np.loadtxt(path_input_support.joinpath("files_figures.txt"), dtype=str)
+        if len(files.shape) == 0:
+            files = files.reshape(1)
+        files = [path_input_data.joinpath(file) for file in files]
+    elif args.date:
+        print("Executing script in date mode")
+        print("")
+        files = [
+            path_input_data.joinpath(file)
+            for file in os.listdir(path_input_data)
+            if file.endswith(EXT)
+        ]
+        #find the date from export_date in the file name considering the format YYYYMMDD in the file name:
+        files = [file for file in files if export_date.strftime("%Y%m%d") in file.name]
+    else:
+        print("ERRO. please, check if the arguments are rights")
+        quit()
+
+    # check if there is at least one file to process
+    if len(files) == 0:
+        print("ERRO. No file to process")
+        quit()
+
+    if args.png:
+        print("Executing script in png mode. Only PNG files are included in the output")
+
+    # the files whose content, json files, code and options did not change since their figures were
+    # generated are skipped
+    if args.skip_unchanged:
+        manifest = manifest_utils.FigureManifest(path_output_fig)
+        config_hash = manifest_utils.get_config_hash(
+            [
+                path_input_support.joinpath("variables_info.json"),
+                path_input_support.joinpath("netCDF_info_ARM.json"),
+                pathlib.Path(__file__),
+                pathlib.Path(utils.__file__),
+            ],
+            [args.png, args.png_backend],
         )
+        n_files = len(files)
+        files = [file for file in files if not manifest.is_unchanged(file, config_hash)]
+        print(n_files - len(files), "unchanged files were skipped")
+        if len(files) == 0:
+            manifest.save()
+            print("No figures to be generated")
+            quit()
+
+    # the figures of the files are generated in a process pool with -j/--jobs, each worker with its own
+    # PNG renderer
+    failed = []
+    for i, (file, log, error) in enumerate(utils.generate_files_figures(files, variables_info, netCDF_info, path_output_fig, args.png, args.png_backend, workers=args.jobs), 1):
+        print("[{}/{}] ".format(i, len(files)) + log, end="")
+        if error is not None:
+            print("ERROR: The figures of the file {} were not generated".format(file.name))
+            print(error)
+            failed.append(file.name)
+        elif args.skip_unchanged:
+            # only the files whose figures were generated are recorded, the failed ones are generated again in the next run
+            manifest.update(file, config_hash)
+            if i % 30 == 0:
+                manifest.save()
+
+    if args.skip_unchanged:
+        manifest.save()
+    if len(failed) > 0:
+        print("The figures of", len(failed), "files were not generated:", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # the workers of the process pools import this module, only the main process runs the script
+    main()
@@ -5,10 +5,14 @@ import numpy as np
 from datetime import datetime, timedelta
 import os
 import gc
+import itertools
+import sys
 import pathlib
 import json
 import utils.disdrometer_utils as disd
 import utils.netcdf_utils as cdf
+import utils.cache_utils as cache_utils
+import utils.manifest_utils as manifest_utils
 
 # ##################### ARGUMENTS ######################
 
@@ -28,7 +32,7 @@ JOSS_parser.add_argument(
     "--date",
     action="store",
     default=None,
-    help="Expect exporting date in format -d dd/mm/YYYY ou --date dd/mm/YYYY. Read all data inside the data input folder and extract the data for the date specified.",
+    help="Expect exporting date in format -d dd/mm/YYYY ou --date dd/mm/YYYY. Read only the files of the data input folder that have data of the date specified (see input/time_index.json) and extract the data for the date specified.",
 )
 JOSS_parser.add_argument(
     "-s",
@@ -49,7 +53,7 @@ JOSS_parser.add_argument(
     "--pattern",
     action="store",
     default=None,
-    help=f"Expect the format of the date contained in file names, use python strftime formats (https://strftime.org/) for input like %%Y%%m%%d. Read the files inside the data input folder only for one day before to one day after the date input",
+    help="Expect a date in format -p dd/mm/YYYY. Read only the files of the data input folder that have data of the date (first and last datestamps of each file in input/time_index.json) and export the date",
 )
 JOSS_parser.add_argument(
     "-i",
@@ -58,152 +62,375 @@ JOSS_parser.add_argument(
     default=None,
     help="Path to the input folder containing the data files",
 )
+JOSS_parser.add_argument(
+    "-j",
+    "--jobs",
+    action="store",
+    type=int,
+    default=None,
+    help="Number of worker processes used to read the input files and to generate the netCDF files of the days (default: serially). With --stream the files are read serially and the workers generate the days",
+)
+JOSS_parser.add_argument(
+    "--stream",
+    action="store_true",
+    default=None,
+    help="Read the files in time order and generate each day as soon as it is complete, keeping only a couple of days of data in memory",
+)
+JOSS_parser.add_argument(
+    "--pipeline",
+    action="store_true",
+    default=None,
+    help="Write the netCDF files in a background thread while the next days are calculated (used when the days are generated serially)",
+)
+JOSS_parser.add_argument(
+    "--skip-empty",
+    action="store_true",
+    default=None,
+    help="Do not generate netCDF files for the days without any data (instrument outages)",
+)
+JOSS_parser.add_argument(
+    "--incremental",
+    action="store_true",
+    default=None,
+    help="Generate only the days covered by new, changed or deleted input files since the last incremental run, reading only the files that overlap these days (see input/incremental_state.json)",
+)
+JOSS_parser.add_argument(
+    "--skip-unchanged",
+    action="store_true",
+    default=None,
+    help="Do not generate again the days whose input data, json files, code and options did not change since their netCDF file was generated (see output/netCDF/manifest.json)",
+)
+JOSS_parser.add_argument(
+    "--format",
+    action="store",
+    choices=["NETCDF3_CLASSIC", "NETCDF4", "NETCDF4_CLASSIC"],
+    default="NETCDF3_CLASSIC",
+    help="Format of the netCDF files (default: NETCDF3_CLASSIC, ARM compatible). The NETCDF4 formats are compressed",
+)
+JOSS_parser.add_argument(
+    "--complevel",
+    action="store",
+    type=int,
+    choices=range(10),
+    default=4,
+    help="Deflate level (0-9) of the variables in the NETCDF4 formats (default: 4), 0 means no compression",
+)
+JOSS_parser.add_argument(
+    "--compression-report",
+    action="store_true",
+    default=None,
+    help="Write the first day with every deflate level, print the size and write time of each one and exit",
+)
+JOSS_parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    default=None,
+    help="Do not use the cache of parsed input files (input/cache folder), parse all files",
+)
+JOSS_parser.add_argument(
+    "--rebuild-cache",
+    action="store_true",
+    default=None,
+    help="Delete the cache of parsed input files and build it again",
+)
+JOSS_parser.add_argument(
+    "--cache-size",
+    action="store",
+    type=int,
+    default=2048,
+    help="Maximum size of the cache of parsed input files in MB (default: 2048), the least recently used files are removed",
+)
 
-# Execute the parse_args() method
-args = JOSS_parser.parse_args()
-    
-if args.date:
-    try:
-        export_date = datetime.strptime(args.date.strip(), "%d/%m/%Y")
-    except Exception:
-        JOSS_parser.error("Bad date format, see --help for further information")
 
-if args.pattern:
-    try:
-        export_date = datetime.strptime(args.pattern.strip(), "%d/%m/%Y")
-    except Exception:
-        JOSS_parser.error("Bad date format, see --help for further information") 
-        
-
-# #check if there is at least one action requested
-
-# Define the invalid action combinations
-invalid_combinations = [
-    (args.standard, args.list),
-    (args.standard, args.pattern),
-    (args.list, args.pattern),
-    (args.pattern, args.date),
-]
-
-# Check if at least one action is requested
-if all(action is None for action in [args.standard, args.list, args.pattern, args.date]):
-    JOSS_parser.error("No action requested, see --help for further information")
-
-# Check for invalid action combinations
-if any(action1 is not None and action2 is not None for action1, action2 in invalid_combinations):
-    JOSS_parser.error("Invalid action requested, see --help for further information")
-
-# Check if date is used with -s or -l options
-if args.date and not (args.standard or args.list):
-    JOSS_parser.error("Invalid action requested, date needs to be used with -s or -l, see --help for further information")
-    
-
-###################### Defining directories #####################
-
-# Folders and files path
-path_input = pathlib.Path(args.input) if args.input else pathlib.Path.cwd().joinpath("input")
-path_input_data = path_input.joinpath("input")
-path_input_support = path_input.joinpath("support")
-path_output_data = path_input.joinpath("output", "netCDF")
-
-# ##################### reading all file names in folder or list ##################### 
-
-# reading auxiliar data:
-with open(path_input_support.joinpath("variables_info.json"), "r") as xfile:
-    variables_info_file = xfile.read()
-variables_info = json.loads(variables_info_file)
-
-columns = list(variables_info['Columns'])
-
-with open(path_input_support.joinpath("netCDF_info_ARM.json"), "r") as xfile:
-    netCDF_info_file = xfile.read()
-netCDF_info = json.loads(netCDF_info_file)
-
-# reading data from the equipment:
-
-EXT = variables_info["input_file_extension"]
-if args.standard:
-    # check if export_date is declared
-    if "export_date" not in locals():
-        export_date = None
-    print("Executing script in standard mode")
-    print("")
-    files = [
-        path_input_data.joinpath(file)
-        for file in os.listdir(path_input_data)
-        if file.endswith(EXT)
-    ]
-elif args.list:
-    print("Executing script in list mode")
-    print("")
-    if "export_date" not in locals():
-        export_date = None
-    if not path_input_support.joinpath("files.txt").exists():
-        with open(path_input_support.joinpath("files.txt"), "w") as xfile:
-            xfile.write("")
-    files = np.loadtxt(path_input_support.joinpath("files.txt"), dtype=str)
-    if len(files.shape) == 0:
-        files = files.reshape(1)
-    files = [path_input_data.joinpath(file) for file in files]
-    
-elif args.pattern:
-    print("Executing script in pattern mode")
-    print("")
-    export_date = datetime.strptime(args.pattern.strip(), "%d/%m/%Y")
-    d0 = export_date.strftime("%Y%m%d")
-    d1 = (export_date - timedelta(days=1)).strftime("%Y%m%d")
-    d2 = (export_date + timedelta(days=1)).strftime("%Y%m%d")
-    # Find the files containing d0, d1, or d2 in the file name
-    files = [
-        path_input_data.joinpath(file)
-        for days in [d1, d0, d2]
-        for file in os.listdir(path_input_data)
-        if days in file
+def main():
+
+    # Execute the parse_args() method
+    args = JOSS_parser.parse_args()
+
+    if args.date:
+        try:
+            export_date = datetime.strptime(args.date.strip(), "%d/%m/%Y")
+        except Exception:
+            JOSS_parser.error("Bad date format, see --help for further information")
+
+    if args.pattern:
+        try:
+            export_date = datetime.strptime(args.pattern.strip(), "%d/%m/%Y")
+        except Exception:
+            JOSS_parser.error("Bad date format, see --help for further information") 
+
+
+    # #check if there is at least one action requested
+
+    # Define the invalid action combinations
+    invalid_combinations = [
+        (args.standard, args.list),
+        (args.standard, args.pattern),
+        (args.list, args.pattern),
+        (args.pattern, args.date),
     ]
-    # Remove duplicates
-    files = list(dict.fromkeys(files))
-    # Sort the list
-    files.sort()
-
-# check if there is at least one file to be processed
-if len(files) == 0:
-    print("No files to be processed")
-    quit()
 
-# call the fuction that read all files
-all_data = disd.read_files_rd80(files, columns)
+    # Check if at least one action is requested
+    if all(action is None for action in [args.standard, args.list, args.pattern, args.date]):
+        JOSS_parser.error("No action requested, see --help for further information")
+
+    # Check for invalid action combinations
+    if any(action1 is not None and action2 is not None for action1, action2 in invalid_combinations):
+        JOSS_parser.error("Invalid action requested, see --help for further information")
+
+    # Check if date is used with -s or -l options
+    if args.date and not (args.standard or args.list):
+        JOSS_parser.error("Invalid action requested, date needs to be used with -s or -l, see --help for further information")
+
+    if args.pipeline and args.jobs is not None and args.jobs > 1:
+        JOSS_parser.error("Invalid action requested, --pipeline can not be used with -j/--jobs, the workers already write their days, see --help for further information")
+
+    if args.incremental and (args.date or args.pattern or args.stream):
+        JOSS_parser.error("Invalid action requested, --incremental can not be used with -d, -p or --stream, see --help for further information")
+
+    if args.no_cache and args.rebuild_cache:
+        JOSS_parser.error("Invalid action requested, --no-cache can not be used with --rebuild-cache, see --help for further information")
+
 
-# ##################### Generate netcdf file(s) ##################### 
-# data processing
-while True:
+    ###################### Defining directories #####################
 
-    (export_date, day_data, flag) = disd.get_day_data(all_data, export_date, variables_info)
+    # Folders and files path
+    path_input = pathlib.Path(args.input) if args.input else pathlib.Path.cwd().joinpath("input")
+    path_input_data = path_input.joinpath("input")
+    path_input_support = path_input.joinpath("support")
+    path_output_data = path_input.joinpath("output", "netCDF")
+    path_cache = path_input.joinpath("cache")
 
-    if flag:
-        break
+    # temporary files of a run that was killed while writing
+    if path_output_data.exists():
+        cdf.clean_temp_files(path_output_data)
 
-    if day_data.shape[0] != 0:
+    # ##################### reading all file names in folder or list ##################### 
 
-        print("Generating netCDF file for", day_data.index[0].strftime("%d/%m/%Y"))
-        (dimension_nc,filled_variables) = cdf.extract_variables(day_data,variables_info,netCDF_info)
+    # reading auxiliar data:
+    with open(path_input_support.joinpath("variables_info.json"), "r") as xfile:
+        variables_info_file = xfile.read()
+    variables_info = json.loads(variables_info_file)
 
-        cdf_filename = (netCDF_info['global attributes']['datastream']['long_name']+"."+ day_data.index[0].strftime("%Y%m%d.%H%M%S")+".nc")
+    columns = list(variables_info['Columns'])
 
-        cdf.generate_netCDF(
-            cdf_filename,
-            dimension_nc,
-            filled_variables,
-            netCDF_info,
-            path_output_data,
-            day_data['no-data']
+    # constant vectors of the raindrop classes used to calculate the variables
+    instrument = disd.Instrument(variables_info)
+
+    with open(path_input_support.joinpath("netCDF_info_ARM.json"), "r") as xfile:
+        netCDF_info_file = xfile.read()
+    netCDF_info = json.loads(netCDF_info_file)
+
+    # netCDF_info compiled (and validated) once, before reading the data
+    plan = cdf.WritePlan(netCDF_info, nc_format=args.format, complevel=args.complevel)
+
+    # reading data from the equipment:
+
+    EXT = variables_info["input_file_extension"]
+    if args.standard:
+        # check if export_date is declared
+        if "export_date" not in locals():
+            export_date = None
+        print("Executing script in standard mode")
+        print("")
+        files = [
+            path_input_data.joinpath(file)
+            for file in os.listdir(path_input_data)
+            if file.endswith(EXT)
+        ]
+    elif args.list:
+        print("Executing script in list mode")
+        print("")
+        if "export_date" not in locals():
+            export_date = None
+        if not path_input_support.joinpath("files.txt").exists():
+            with open(path_input_support.joinpath("files.txt"), "w") as xfile:
+                xfile.write("")
+        files = np.loadtxt(path_input_support.joinpath("files.txt"), dtype=str)
+        if len(files.shape) == 0:
+            files = files.reshape(1)
+        files = [path_input_data.joinpath(file) for file in files]
+
+    elif args.pattern:
+        print("Executing script in pattern mode")
+        print("")
+        export_date = datetime.strptime(args.pattern.strip(), "%d/%m/%Y")
+        files = [
+            path_input_data.joinpath(file)
+            for file in os.listdir(path_input_data)
+            if file.endswith(EXT)
+        ]
+
+    # date requested: only the files that overlap the day are read, the time range of each file is
+    # read from its first and last lines and kept in the index
+    if export_date is not None:
+        time_index = manifest_utils.FileTimeIndex(path_input)
+        n_files = len(files)
+        files = time_index.select_files(files, export_date, export_date + timedelta(days=1))
+        time_index.save()
+        print(len(files), "of", n_files, "files have data of", export_date.strftime("%d/%m/%Y"))
+        print("")
+
+    # check if there is at least one file to be processed
+    if len(files) == 0:
+        print("No files to be processed")
+        quit()
+
+    # cache of the parsed files, only new or changed files (or files parsed by another version of the
+    # reading code) are parsed
+    if args.no_cache:
+        cache = None
+    else:
+        parser_hash = manifest_utils.get_config_hash([pathlib.Path(disd.__file__), pathlib.Path(cache_utils.__file__)])
+        cache = cache_utils.ParsedFilesCache(
+            path_cache, max_size_mb=args.cache_size, rebuild=args.rebuild_cache, parser_hash=parser_hash
         )
+
+    # incremental mode: only the days covered by the new, changed or deleted files (their current and previous
+    # time ranges) are generated again, and only the files that overlap these days are read
+    selectors = []
+    if args.incremental:
+        state = manifest_utils.InputState(path_input)
+        changed = set(file for file in files if state.is_changed(file))
+        removed = state.get_removed()
+        file_ranges = {
+            file: disd.get_time_range_rd80(file) if file in changed else state.get_range(state.get_key(file))
+            for file in files
+        }
+        old_ranges = [
+            state.get_range(key)
+            for key in [state.get_key(file) for file in changed] + removed
+            if key in state.entries
+        ]
+        touched = manifest_utils.get_touched_days(file_ranges, changed, old_ranges)
+
+        files = [
+            file
+            for file in files
+            if any(day in touched for day in manifest_utils.get_range_days(*file_ranges[file]))
+        ]
+        print("Incremental mode:", len(changed), "new or changed files,", len(removed), "deleted files,", len(touched), "days to generate,", len(files), "files to read")
         print("")
+        selectors.append(lambda day, rows: day in touched)
+
+        if len(files) == 0:
+            # nothing to generate (e.g. only files without data), the state is updated
+            for file in changed:
+                state.update(file, *file_ranges[file])
+            for key in removed:
+                state.remove(key)
+            state.save()
+            print("No days to be generated")
+            quit()
+
+    # fingerprints of the days: the days whose input rows, json files, code and options did not change
+    # are not calculated and generated again
+    if args.skip_unchanged:
+        manifest = manifest_utils.OutputManifest(path_output_data)
+        config_hash = manifest_utils.get_config_hash(
+            [
+                path_input_support.joinpath("variables_info.json"),
+                path_input_support.joinpath("netCDF_info_ARM.json"),
+                pathlib.Path(__file__),
+                pathlib.Path(disd.__file__),
+                pathlib.Path(cdf.__file__),
+            ],
+            # the deflate level only changes the files of the NETCDF4 formats
+            [args.format, args.complevel] if args.format.startswith("NETCDF4") else [args.format],
+        )
+        fingerprints = {}
+        unchanged = []
+
+        def select_day(day, rows):
+            filename = cdf.get_cdf_filename(netCDF_info, day)
+            fingerprint = manifest_utils.get_day_fingerprint(rows, config_hash)
+            if manifest.is_unchanged(filename, fingerprint):
+                unchanged.append(day)
+                return False
+            fingerprints[filename] = fingerprint
+            return True
+
+        selectors.append(select_day)
+
+    # the days are calculated and generated only if all the selectors return True
+    if len(selectors) > 0:
+        select_day = lambda day, rows: all(select(day, rows) for select in selectors)
+    else:
+        select_day = None
+
+    if args.stream:
+        # the files are read in time order, each day is yielded as soon as it is complete
+        # (the variables are calculated day by day). The files are read serially, -j/--jobs is used by
+        # the pool generating the days (a single process pool)
+        days = (
+            (day_data, None)
+            for day_data in disd.stream_day_data(files, columns, variables_info, export_date, cache=cache, skip_empty=args.skip_empty, select=select_day)
+        )
+    else:
+        # call the fuction that read all files
+        all_data = disd.read_files_rd80(files, columns, workers=args.jobs, cache=cache)
+        # the variables are calculated for blocks of days at once and sliced for each day
+        days = disd.iter_day_variables(all_data, export_date, variables_info, instrument, skip_empty=args.skip_empty, select=select_day)
+
+    # ##################### Generate netcdf file(s) ##################### 
+    # only the days with data (the days of the outages are complete days of missing values)
+    days = ((day_data, day_variables) for day_data, day_variables in days if day_data.shape[0] != 0)
 
     if args.date or args.pattern:
-        break
+        # only the first day, with --skip-empty the first day yielded is not the date requested if it has no data
+        days = (
+            (day_data, day_variables)
+            for day_data, day_variables in itertools.islice(days, 1)
+            if day_data.index[0].date() == export_date.date()
+        )
+
+    if args.compression_report:
+        for day_data, day_variables in itertools.islice(days, 1):
+            (dimension_nc,filled_variables) = cdf.extract_variables(day_data,variables_info,netCDF_info,instrument,day_variables,plan)
+            cdf.print_compression_report(
+                cdf.compression_report(dimension_nc, filled_variables, netCDF_info, day_data['no-data'])
+            )
+        quit()
+
+    # data processing, the days are generated in a process pool with -j/--jobs or written by a background
+    # thread with --pipeline
+    failed = []
+    for i, (day_data, valid_range, log, error) in enumerate(cdf.generate_days_netCDF(days, variables_info, netCDF_info, instrument, plan, path_output_data, workers=args.jobs, pipeline=args.pipeline), 1):
+
+        print(log, end="")
+        if error is not None:
+            print("ERROR: The netCDF file for", day_data.index[0].strftime("%d/%m/%Y"), "was not generated")
+            print(error)
+            failed.append(day_data.index[0].strftime("%d/%m/%Y"))
+        elif args.skip_unchanged:
+            # only the days that were generated are recorded, the failed ones are generated again in the next run
+            filename = cdf.get_cdf_filename(netCDF_info, day_data.index[0])
+            manifest.update(filename, fingerprints.pop(filename))
+            if i % 30 == 0:
+                manifest.save()
+        print("")
+
+        gc.collect()
+
+    # end of data processing
+    if args.skip_unchanged:
+        manifest.save()
+        print(len(unchanged), "unchanged days were skipped")
+    if args.incremental:
+        # the files are recorded in the state if all their days were generated, the others are processed again in the next run
+        for file in changed:
+            if not any(day.strftime("%d/%m/%Y") in failed for day in manifest_utils.get_range_days(*file_ranges[file])):
+                state.update(file, *file_ranges[file])
+        for key in removed:
+            state.remove(key)
+        state.save()
+    if len(failed) > 0:
+        print("The netCDF files of", len(failed), "days were not generated:", ", ".join(failed))
+        sys.exit(1)
+    print("All data have been processed.")
+    quit()
 
-    gc.collect()
 
-# end of data processing
-print("All data have been processed.")
-quit()
+if __name__ == "__main__":
+    # the workers of the process pools import this module, only the main process runs the script
+    main()
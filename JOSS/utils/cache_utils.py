@@ -0,0 +1,120 @@
+import hashlib
+import os
+import pathlib
+import time
+import numpy as np
+import pandas as pd
+from utils.store_utils import JsonStore, get_file_entry, is_same_file
+
+
+def frame_to_records(data):
+
+    # one structured array per file: the index (datestamp) is the first field
+    return data.to_records(index=True)
+
+
+def records_to_frame(records):
+
+    # dataframe from a structured array created by frame_to_records
+    names = records.dtype.names
+    return pd.DataFrame(
+        {col: records[col] for col in names[1:]},
+        index=pd.DatetimeIndex(records[names[0]], name=names[0]),
+    )
+
+
+def concat_records(records):
+
+    # concatenate consecutive structured arrays with the same dtype and build the dataframes
+    data = []
+    start = 0
+    for i in range(1, len(records) + 1):
+        if i == len(records) or records[i].dtype != records[start].dtype:
+            data.append(records_to_frame(np.concatenate(records[start:i])))
+            start = i
+    return data
+
+
+# Cache of the parsed raw files (.trf/.txt). Each file is stored as one .npy file with
+# a structured array (one field per column plus the index), the cache index
+# (cache_index.json) keeps for each raw file its size, mtime, content hash, the
+# columns used to parse it and the hash of the parser code (parser_hash): the files
+# parsed by another version of the parser are parsed again.
+class ParsedFilesCache(JsonStore):
+
+    INDEX_FILE = "cache_index.json"
+
+    def __init__(self, path_cache, max_size_mb=2048, rebuild=False, parser_hash=None):
+        self.path_cache = pathlib.Path(path_cache)
+        self.max_size = max_size_mb * 1024 * 1024
+        self.parser_hash = parser_hash
+        self.path_cache.mkdir(parents=True, exist_ok=True)
+
+        super().__init__(self.path_cache.joinpath(self.INDEX_FILE), "The cache index is corrupted, rebuilding the cache")
+        if rebuild or self.corrupted:
+            self.clear()
+
+    def clear(self):
+        for file in self.path_cache.glob("*.npy"):
+            file.unlink()
+        self.entries = {}
+
+    def load(self, file, columns):
+
+        # return the structured array of the file or None if it is not in the cache (or changed, or parsed by
+        # another version of the parser). A file touched (or copied) is still valid if the content is the same
+        key = str(pathlib.Path(file).resolve())
+        entry = self.entries.get(key)
+        if entry is None or entry["columns"] != list(columns) or entry.get("parser") != self.parser_hash:
+            return None
+        if not is_same_file(entry, file):
+            return None
+
+        try:
+            records = np.load(self.path_cache.joinpath(entry["file"]), allow_pickle=False)
+        except (OSError, ValueError):
+            self.entries.pop(key, None)
+            return None
+
+        entry["used"] = time.time()
+        return records
+
+    def store(self, file, columns, records):
+
+        # only numeric columns are stored (no pickle in the .npy files)
+        if any(records.dtype[name].kind not in "biufM" for name in records.dtype.names):
+            return
+
+        key = str(pathlib.Path(file).resolve())
+        cache_file = hashlib.sha1(key.encode()).hexdigest() + ".npy"
+
+        # write in a temporary file and rename it, a killed run never leaves a truncated file
+        tmp_file = self.path_cache.joinpath(cache_file + ".tmp")
+        with open(tmp_file, "wb") as xfile:
+            np.save(xfile, records, allow_pickle=False)
+        os.replace(tmp_file, self.path_cache.joinpath(cache_file))
+
+        entry = get_file_entry(file)
+        entry.update(
+            columns=list(columns),
+            parser=self.parser_hash,
+            file=cache_file,
+            bytes=self.path_cache.joinpath(cache_file).stat().st_size,
+            used=time.time(),
+        )
+        self.entries[key] = entry
+
+    def evict(self):
+
+        # remove the least recently used files until the cache is smaller than max_size
+        total = sum(entry["bytes"] for entry in self.entries.values())
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1]["used"]):
+            if total <= self.max_size:
+                break
+            self.path_cache.joinpath(entry["file"]).unlink(missing_ok=True)
+            total -= entry["bytes"]
+            del self.entries[key]
+
+    def save(self):
+        self.evict()
+        super().save()
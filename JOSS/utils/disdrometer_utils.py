@@ -1,50 +1,254 @@
+import io
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import datetime
 import numpy as np
 import math
 import warnings
+import utils.cache_utils as cache_utils
 warnings.filterwarnings("ignore")
 
 # FUNCTIONS TO READ THE FILES
 
-def read_files_rd80(files, columns):
-    joss_date_parser = lambda x: datetime.strptime(x, "%Y-%m-%d %H:%M:%S")
-
-    # data is a list of dataframes containg the data from each file
-    data = [
-        pd.read_csv(
-            file,
-            sep="\s",
-            header=None,
-            names=columns,
-            skiprows=[0],
-            index_col=[0],
-            parse_dates=[[0, 1]],
-            date_parser=joss_date_parser,
-            decimal=",",
-            dtype={"RI": np.float64, "RA": np.float64, "RAT": np.float64},
-            engine="python",
-        )
-        for file in files
-    ]
+def get_separator_rd80(line):
+
+    # the RD-80 files are tab separated, but some sites export them with single spaces:
+    # the separator is the character right after the date (YYYY-MM-DD) of the first data line
+    # (blank lines after the header are skipped)
+    return " " if line.lstrip()[10:11] == b" " else "\t"
+
+
+def join_files_rd80(files):
+
+    # concatenate the body (without the header line) of consecutive files with the same
+    # separator, so a whole batch of files is parsed by a single read_csv call
+    runs = []
+    for file in files:
+        with open(file, "rb") as xfile:
+            xfile.readline()
+            body = xfile.read()
+        if len(body.strip()) == 0:
+            continue
+        if not body.endswith(b"\n"):
+            body += b"\n"
+        sep = get_separator_rd80(body)
+        if runs and runs[-1][0] == sep:
+            runs[-1][1].append(body)
+        else:
+            runs.append((sep, [body]))
+
+    return [(sep, b"".join(bodies)) for sep, bodies in runs]
+
+
+def parse_rd80(content, sep, columns):
+
+    # read with the C engine (single character separator), Date and Time are kept as strings
+    data = pd.read_csv(
+        io.BytesIO(content),
+        sep=sep,
+        header=None,
+        names=columns,
+        decimal=",",
+        dtype={columns[0]: str, columns[1]: str, "RI": np.float64, "RA": np.float64, "RAT": np.float64},
+        engine="c",
+    )
+
+    # vectorized fixed format parse of Date + Time used as index (datestamp)
+    date_time = pd.to_datetime(
+        data.pop(columns[0]) + " " + data.pop(columns[1]),
+        format="%Y-%m-%d %H:%M:%S",
+    )
+    data.index = pd.DatetimeIndex(date_time, name=columns[0] + "_" + columns[1])
+
+    return data
+
+
+def read_chunk_rd80(files, columns):
+
+    # parse a chunk of files (used by the workers of the process pool)
+    return [parse_rd80(content, sep, columns) for sep, content in join_files_rd80(files)]
+
+
+def read_file_rd80(file, columns):
+
+    # parse a single file, None if the file has no data
+    data = read_chunk_rd80([file], columns)
+    return data[0] if len(data) > 0 else None
+
+
+def read_chunk_files_rd80(files, columns):
+
+    # parse a chunk of files keeping one dataframe (or None) per file
+    return [read_file_rd80(file, columns) for file in files]
+
+
+def map_files_rd80(function, files, columns, workers=None):
+
+    # apply function(files, columns) to ordered chunks of files, in a process pool if requested
+    if workers is not None and workers > 1 and len(files) > 1:
+        # a few chunks per worker to balance the load, executor.map keeps the order of the chunks
+        size = max(1, math.ceil(len(files) / (workers * 4)))
+        chunks = [files[i:i + size] for i in range(0, len(files), size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(function, chunks, [columns] * len(chunks)))
+
+    return [function(files, columns)]
+
+
+def sort_files_rd80(files):
+
+    # the files with data in reading order (datestamp of their first data line, then name) and their first
+    # datestamps. When files share a datestamp the row of the first file in this order is kept: read_files_rd80
+    # and stream_day_data concatenate the files in this order and sort the rows with a stable sort
+    starts = sorted(
+        (start, str(file), file)
+        for file, start in ((file, get_time_range_rd80(file)[0]) for file in files)
+        if start is not None
+    )
+    return [file for _, _, file in starts], [start for start, _, _ in starts]
+
+
+def read_files_rd80(files, columns, workers=None, cache=None):
+
+    files, _ = sort_files_rd80(files)
+    if cache is not None:
+        # load the files from the cache and parse only the new (or changed) ones, file by file
+        records = [cache.load(file, columns) for file in files]
+        missing = [i for i, rec in enumerate(records) if rec is None]
+        parsed = [
+            frame
+            for frames in map_files_rd80(read_chunk_files_rd80, [files[i] for i in missing], columns, workers)
+            for frame in frames
+        ]
+        for i, frame in zip(missing, parsed):
+            if frame is not None:
+                records[i] = cache_utils.frame_to_records(frame)
+                cache.store(files[i], columns, records[i])
+        cache.save()
+        data = cache_utils.concat_records([rec for rec in records if rec is not None])
+        print("Files read from the cache:", len(files) - len(missing), "- files parsed:", len(missing))
+    else:
+        # data is a list of dataframes containg the data from each batch of files
+        data = [
+            frame
+            for frames in map_files_rd80(read_chunk_rd80, files, columns, workers)
+            for frame in frames
+        ]
 
     # all data receives the data from all files and sorteb by index (datestamp)
-    all_data = pd.concat(data).sort_index()
+    all_data = pd.concat(data).sort_index(kind="stable")
     # Remove duplicate index (datestamp) and keep the first one
     all_data = all_data[~all_data.index.duplicated(keep="first")]
     
     return all_data
 
 
-def get_day_data(all_data, export_date, variables_info):
+def get_line_time_rd80(line):
+
+    # datestamp of a data line (bytes) of the file
+    return datetime.strptime(line[:10].decode() + " " + line[11:19].decode(), "%Y-%m-%d %H:%M:%S")
+
+
+def get_time_range_rd80(file, block_size=4096):
+
+    # datestamps of the first and the last data lines of the file ((None, None) if the file has no data),
+    # only the first lines and the tail of the file are read (seek to the last block_size bytes, the block
+    # is doubled until it has a complete data line)
+    with open(file, "rb") as xfile:
+        xfile.readline()
+        start = xfile.tell()
+        first = xfile.readline()
+        while len(first) > 0 and len(first.strip()) == 0:
+            first = xfile.readline()
+        if len(first) == 0:
+            return None, None
+
+        end = xfile.seek(0, 2)
+        while True:
+            position = max(start, end - block_size)
+            xfile.seek(position)
+            lines = xfile.read(end - position).splitlines()
+            if position > start:
+                # the first line of the block may be incomplete
+                lines = lines[1:]
+            lines = [line for line in lines if len(line.strip()) > 0]
+            if len(lines) > 0 or position == start:
+                break
+            block_size *= 2
+
+    return get_line_time_rd80(first), get_line_time_rd80(lines[-1])
+
+
+def iter_files_rd80(files, columns, cache=None):
+
+    # yield the dataframe (or None if the file has no data) of each file in order
+    try:
+        for file in files:
+            records = cache.load(file, columns) if cache is not None else None
+            if records is not None:
+                yield cache_utils.records_to_frame(records)
+                continue
+            data = read_file_rd80(file, columns)
+            if cache is not None and data is not None:
+                cache.store(file, columns, cache_utils.frame_to_records(data))
+            yield data
+    finally:
+        if cache is not None:
+            cache.save()
+
+
+def stream_day_data(files, columns, variables_info, export_date=None, cache=None, skip_empty=False, select=None):
+
+    # streaming version of read_files_rd80 + iter_day_variables: the files are read in time order
+    # and each day is yielded as soon as the next file starts after it, so only a couple of
+    # days of data are kept in memory. If select is given, select(day, rows) is called with the
+    # rows of the day (before reindexing) and the day is only yielded if it returns True
+    files, starts = sort_files_rd80(files)
+    starts = [pd.Timestamp(start).floor("D") for start in starts]
+
+    one_day = pd.Timedelta(days=1)
+    export_day = pd.Timestamp(export_date).floor("D") if export_date is not None else None
+    buffer = None
+    day = export_day
+
+    for i, data in enumerate(iter_files_rd80(files, columns, cache=cache)):
+        if data is not None:
+            buffer = data if buffer is None else pd.concat([buffer, data])
+            # sort by index (datestamp) and keep the first of the duplicated ones
+            buffer = buffer.sort_index(kind="stable")
+            buffer = buffer[~buffer.index.duplicated(keep="first")]
+        if buffer is None:
+            continue
+
+        if day is None:
+            day = buffer.index[0].floor("D")
+
+        # the days before the start of the next file are complete (the last file closes all days)
+        if i + 1 < len(files):
+            limit = starts[i + 1]
+        elif len(buffer) > 0:
+            limit = buffer.index[-1].floor("D") + one_day
+        else:
+            limit = day
+        while day < limit:
+            first, last = buffer.index.searchsorted([day, day + one_day])
+            # the days without data (instrument outages) are skipped if skip_empty is True
+            if (
+                (export_day is None or day == export_day)
+                and not (skip_empty and first == last)
+                and (select is None or select(day, buffer.iloc[first:last]))
+            ):
+                start_date, end_date, day_idx = get_day_index(day, variables_info)
+                yield reindex_day_data(buffer, day_idx).loc[start_date:end_date]
+            if day == export_day:
+                return
+            day += one_day
+
+        buffer = buffer[buffer.index >= day]
+
+
+def get_day_index(export_date, variables_info):
 
-    # last date of the data
-    aux_datetime = all_data.index[-1] 
-
-    # if export_date is None, the first date of the data is used
-    if export_date == None:
-        export_date = all_data.index[0]
-    
     # start and end date of the day
     start_date = datetime(export_date.year, export_date.month, export_date.day, 0, 0)
 
@@ -58,20 +262,82 @@ def get_day_data(all_data, export_date, variables_info):
         freq=str(variables_info["integration_time"]) + "S",
     )
 
+    return start_date, end_date, day_idx
+
+
+def reindex_day_data(data, day_idx):
+
     # reindex the dataframe with the day index and fill the missing values with NaN
     # Initial set to -9999 to be able to identify the no-data values
     # The no-data values are the ones that have the "RI" column equal to -9999
     # The no-data values are used to calculate the filters
-    all_data = all_data.reindex(day_idx, fill_value=-9999)
-    all_data["no-data"] = all_data["RI"] == -9999
-    all_data.replace(-9999, np.nan, inplace=True)
-
-    # return dataframe with one day data, the next day to be exported and a boolean to break the loop
-    return (
-        export_date + timedelta(days=1),
-        all_data.loc[start_date:end_date],
-        start_date > aux_datetime,
-    )
+    data = data.reindex(day_idx, fill_value=-9999)
+    data["no-data"] = data["RI"] == -9999
+    data.replace(-9999, np.nan, inplace=True)
+
+    return data
+
+
+def iter_day_variables(all_data, export_date, variables_info, instrument, block_days=31, skip_empty=False, select=None):
+
+    # yield the data and the variables (see get_batch_variables_rd80, None if instrument is None)
+    # of each day, from export_date (or the first day) to the last day of all_data.
+    # Only the days that have rows in all_data are reindexed: they are processed in blocks, the
+    # rows of a block are found with searchsorted (all_data is sorted), reindexed once on the grid
+    # of the whole block, the variables are calculated once for the block and each day is a slice
+    # of it. The days without data (instrument outages) are all no-data days built from an empty
+    # frame, or skipped if skip_empty is True. If select is given, select(day, rows) is called with
+    # the rows of each day (before reindexing) and only the days for which it returns True are
+    # reindexed, calculated and yielded
+    if len(all_data) == 0:
+        return
+
+    first_day = pd.Timestamp(all_data.index[0] if export_date is None else export_date).floor("D")
+    days = pd.date_range(first_day, all_data.index[-1].floor("D"), freq="D")
+    has_data = days.isin(all_data.index.normalize().unique())
+    if skip_empty:
+        days, has_data = days[has_data], has_data[has_data]
+    if select is not None and len(days) > 0:
+        bounds = all_data.index.searchsorted(days.append(days[-1:] + pd.Timedelta(days=1)))
+        selected = np.array([select(day, all_data.iloc[bounds[i]:bounds[i + 1]]) for i, day in enumerate(days)], dtype=bool)
+        days, has_data = days[selected], has_data[selected]
+    data_days = days[has_data]
+
+    blocks = iter_day_blocks(all_data, data_days, variables_info, instrument, block_days)
+    data_days = set(data_days)
+
+    for day in days:
+        if day in data_days:
+            yield next(blocks)
+        elif not skip_empty:
+            start_date, end_date, day_idx = get_day_index(day, variables_info)
+            day_data = reindex_day_data(all_data.iloc[0:0], day_idx)
+            if instrument is None:
+                yield day_data, None
+            else:
+                yield day_data, get_batch_variables_rd80(day_data, variables_info, instrument)
+
+
+def iter_day_blocks(all_data, days, variables_info, instrument=None, block_days=31):
+
+    # yield the data and the variables of each day in days, reindexing all_data in blocks of block_days days
+    for i in range(0, len(days), block_days):
+        block = days[i:i + block_days]
+        day_idxs = [get_day_index(day, variables_info)[2] for day in block]
+        first, last = all_data.index.searchsorted([block[0], block[-1] + pd.Timedelta(days=1)])
+
+        block_data = reindex_day_data(all_data.iloc[first:last], day_idxs[0].append(day_idxs[1:]))
+        if instrument is not None:
+            block_variables = get_batch_variables_rd80(block_data, variables_info, instrument)
+
+        start = 0
+        for day_idx in day_idxs:
+            stop = start + len(day_idx)
+            if instrument is None:
+                yield block_data.iloc[start:stop], None
+            else:
+                yield block_data.iloc[start:stop], slice_variables(block_variables, start, stop)
+            start = stop
 
 # FUNCTIONS TO CALCULATE THE FILTERS IN DATA
 
@@ -84,19 +350,43 @@ def get_filter_ni(data, drop_col, min_ni):
 
     return data
 
+# CONSTANT VECTORS OF THE RAINDROP CLASSES
+
+class Instrument:
+
+    # built once from variables_info.json: the vectors of the raindrop classes (and their
+    # products used by the variables) are precomputed as float arrays and applied to the
+    # counts (times x raindrop classes) by broadcasting
+    def __init__(self, variables_info):
+        self.drop_diam = np.asarray(variables_info["drop_mean_diam"], dtype=np.float64)
+        self.fall_vell = np.asarray(variables_info["fall_vell"], dtype=np.float64)
+        self.delta_diam = np.asarray(variables_info["delta_diam"], dtype=np.float64)
+        self.sensor_area = float(variables_info["sensor_area"])
+
+        self.d3 = np.power(self.drop_diam, 3)
+        self.d6 = np.power(self.drop_diam, 6)
+        self.inv_vel = 1 / self.fall_vell
+        self.vel2 = np.power(self.fall_vell, 2)
+        self.vel_delta_diam = self.fall_vell * self.delta_diam
+        self.inv_area = 1 / self.sensor_area
+
+        # weights of the moments calculated by get_moments_rd80: total, D^3, D^3/v, D^6/v and D^3*v^2
+        self.moment_weights = np.stack(
+            [np.ones_like(self.drop_diam), self.d3, self.d3 * self.inv_vel, self.d6 * self.inv_vel, self.d3 * self.vel2],
+            axis=1,
+        )
+
+
 # FUNCTIONS TO CALCULATE THE VARIABLES
 
-def get_ri_rd80(drop_sizes,interval, drop_diam,sensor_area):
+def get_ri_rd80(drop_sizes, interval, instrument):
 
     # calculate the "constant" based on the interval (it can change!)
     c = (np.pi/6.) * (3.6/(10.**3.))
-    inv_interval = 1 / (sensor_area * interval)
-
-    # extract drop sizes and diameters as NumPy arrays: times x raindrop classes
-    diameters = np.tile(np.array(drop_diam), drop_sizes.shape[0]).reshape(drop_sizes.shape[0],drop_sizes.shape[1])
+    inv_interval = 1 / (instrument.sensor_area * interval)
 
-    # perform the calculation using array operations
-    rain_rate = c * inv_interval * np.sum(drop_sizes * np.power(diameters, 3), axis=1)
+    # perform the calculation using array operations (times x raindrop classes)
+    rain_rate = c * inv_interval * np.sum(drop_sizes * instrument.d3, axis=1)
 
     return rain_rate
 
@@ -109,31 +399,23 @@ def get_ri_rd80(drop_sizes,interval, drop_diam,sensor_area):
 #     return [sum(ra_data[0:i]) for i in range(len(ra_data))]
 
 
-def get_liq_water_rd80(drop_sizes, interval, drop_diam, fall_vell, sensor_area):
+def get_liq_water_rd80(drop_sizes, interval, instrument):
     
     # calculate the "constant" based on the interval (it can change!)
     c = (np.pi/6.)
-    inv_interval = 1 / (sensor_area * interval)
+    inv_interval = 1 / (instrument.sensor_area * interval)
 
-    # extract drop sizes and diameters as NumPy arrays: times x raindrop classes
-    diameters = np.tile(np.array(drop_diam), drop_sizes.shape[0]).reshape(drop_sizes.shape[0],drop_sizes.shape[1])
-    vel = np.tile(np.array(fall_vell), drop_sizes.shape[0]).reshape(drop_sizes.shape[0],drop_sizes.shape[1])
-
-    # perform the calculation using array operations
-    liq_water = c *  inv_interval * np.sum((drop_sizes/vel) * np.power(diameters, 3), axis=1)
+    # perform the calculation using array operations (times x raindrop classes)
+    liq_water = c *  inv_interval * np.sum((drop_sizes/instrument.fall_vell) * instrument.d3, axis=1)
 
     return liq_water/1000.
 
-def get_z_rd80(drop_sizes, interval, drop_diam, fall_vell, sensor_area):
-
-    inv_interval = 1 / (sensor_area * interval)
+def get_z_rd80(drop_sizes, interval, instrument):
 
-    # extract drop sizes and diameters as NumPy arrays: times (1 day=1440) x raindrop classes (RD80=20)
-    diameters = np.tile(np.array(drop_diam), drop_sizes.shape[0]).reshape(drop_sizes.shape[0],drop_sizes.shape[1])
-    vel = np.tile(np.array(fall_vell), drop_sizes.shape[0]).reshape(drop_sizes.shape[0],drop_sizes.shape[1])
+    inv_interval = 1 / (instrument.sensor_area * interval)
 
-    # perform the calculation using array operations
-    z = inv_interval * np.sum((drop_sizes/vel) * np.power(diameters, 6), axis=1)
+    # perform the calculation using array operations: times (1 day=1440) x raindrop classes (RD80=20)
+    z = inv_interval * np.sum((drop_sizes/instrument.fall_vell) * instrument.d6, axis=1)
 
     return z  
 
@@ -144,17 +426,13 @@ def get_zdb(z_data):
     zdbz[z_data == 0] = -99.0
     return zdbz
 
-def get_ek_rd80(drop_sizes, drop_diam, fall_vell, sensor_area):
+def get_ek_rd80(drop_sizes, instrument):
 
     # calculate the "constant" based on the interval (it can change!)
-    c = (np.pi/12.)*(1/sensor_area)*(1/10**6)
+    c = (np.pi/12.)*(1/instrument.sensor_area)*(1/10**6)
 
-    # extract drop sizes and diameters as NumPy arrays: times x raindrop classes
-    diameters = np.tile(np.array(drop_diam), drop_sizes.shape[0]).reshape(drop_sizes.shape[0],drop_sizes.shape[1])
-    vel = np.tile(np.array(fall_vell), drop_sizes.shape[0]).reshape(drop_sizes.shape[0],drop_sizes.shape[1])
-
-    # perform the calculation using array operations
-    ek = c *  np.sum(drop_sizes * np.power(diameters, 3) * np.power(vel, 2), axis=1)
+    # perform the calculation using array operations (times x raindrop classes)
+    ek = c *  np.sum(drop_sizes * instrument.d3 * instrument.vel2, axis=1)
 
     return ek
 
@@ -185,26 +463,156 @@ def get_slope(liq_water_data, z_data):
     return slope
 
 
+def get_class_limits(drop_sizes):
+
+    # first and last raindrop class with drops (> 0) of each time, from the argmax of the
+    # forward and reversed masks (the class is 0 if there is no drop, see get_class_diam)
+    positive = np.asarray(drop_sizes) > 0
+    first = positive.argmax(axis=1)
+    last = positive.shape[1] - 1 - positive[:, ::-1].argmax(axis=1)
+
+    return first, last
+
+
+def get_class_diam(classes, total, drop_diam):
+
+    # diameter of the classes of the times with drops, 0 if there is no drop and NaN if there is no data
+    return np.where(total > 0, np.asarray(drop_diam)[classes], np.where(total == 0, 0., np.nan))
+
+
 def get_d_max(drop_sizes, drop_diam):
 
-    D_max = [drop_diam[np.where(row > 0)[0][-1]] if np.sum(row) > 0 else 0 if np.sum(row) == 0 else np.nan for row in drop_sizes]
+    drop_sizes = np.asarray(drop_sizes)
+    D_max = get_class_diam(get_class_limits(drop_sizes)[1], drop_sizes.sum(axis=1), drop_diam)
     
     return D_max
     
 
 def get_d_min(drop_sizes, drop_diam):
 
-    D_min = [drop_diam[np.where(row > 0)[0][0]] if np.sum(row) > 0 else 0 if np.sum(row) == 0 else np.nan for row in drop_sizes]
+    drop_sizes = np.asarray(drop_sizes)
+    D_min = get_class_diam(get_class_limits(drop_sizes)[0], drop_sizes.sum(axis=1), drop_diam)
     
     return D_min
 
 
-def get_n_d_rd80(drop_sizes,interval, delta_diam, fall_vell):
+def get_n_d_rd80(drop_sizes, interval, instrument):
 
-    # extract drop sizes and diameters as NumPy arrays: times x raindrop classes
-    delta_diam = np.tile(np.array(delta_diam), drop_sizes.shape[0]).reshape(drop_sizes.shape[0],drop_sizes.shape[1])
-    vel = np.tile(np.array(fall_vell), drop_sizes.shape[0]).reshape(drop_sizes.shape[0],drop_sizes.shape[1])
-    
-    n_d = drop_sizes / ((0.005 * interval[:, np.newaxis]) * (vel * delta_diam))
+    # perform the calculation using array operations (times x raindrop classes)
+    n_d = drop_sizes / ((0.005 * interval[:, np.newaxis]) * instrument.vel_delta_diam)
 
     return n_d
+
+
+# FUNCTIONS TO CALCULATE ALL THE VARIABLES IN A SINGLE SWEEP
+
+def get_moments_rd80(drop_sizes, instrument):
+
+    # all the moments of the drop size distribution used by the variables are calculated by a
+    # single matrix product of the counts (times x raindrop classes) with the weights of each class:
+    # total (sum of the counts), D^3, D^3/v, D^6/v and D^3*v^2
+    moments = np.asarray(drop_sizes, dtype=np.float64) @ instrument.moment_weights
+
+    # first and last raindrop class with drops
+    bin_min, bin_max = get_class_limits(drop_sizes)
+
+    return {
+        "total": moments[:, 0],
+        "d3": moments[:, 1],
+        "d3_v": moments[:, 2],
+        "d6_v": moments[:, 3],
+        "d3_v2": moments[:, 4],
+        "bin_min": bin_min,
+        "bin_max": bin_max,
+    }
+
+
+def get_variables_rd80(drop_sizes, interval, instrument):
+
+    # calculate all the variables derived from the counts with the moments of get_moments_rd80,
+    # the formulas are the same of the get_*_rd80 functions above
+    moments = get_moments_rd80(drop_sizes, instrument)
+    inv_interval = 1 / (instrument.sensor_area * interval)
+
+    z = inv_interval * moments["d6_v"]
+    liq_water = (np.pi/6.) * inv_interval * moments["d3_v"] / 1000.
+    ek = (np.pi/12.) * instrument.inv_area * (1/10**6) * moments["d3_v2"]
+
+    return {
+        "number_detected_drops": moments["total"],
+        "diam_max": get_class_diam(moments["bin_max"], moments["total"], instrument.drop_diam),
+        "diam_min": get_class_diam(moments["bin_min"], moments["total"], instrument.drop_diam),
+        "num_drop_density": get_n_d_rd80(drop_sizes, interval, instrument),
+        "rain_rate": (np.pi/6.) * (3.6/(10.**3.)) * inv_interval * moments["d3"],
+        "radar_reflectivity": get_zdb(z),
+        "liq_water": liq_water,
+        "energy_flux": get_ef(ek, interval),
+        "slope_parameter": get_slope(liq_water, z),
+        "distribution_intercept": get_n_0(liq_water, z),
+    }
+
+
+def get_qc_number_detected_particles(number_detected_drops, filter_ni):
+
+    # 0 = good data, 1 = bad data (less drops than filter_ni)
+    qc = np.array(number_detected_drops)
+
+    # Set values to 1 where condition 1 is True
+    cond1 = (number_detected_drops > 0) & (number_detected_drops < filter_ni)
+    qc[cond1] = 1.
+    # Set values to 0 where condition 2 is True
+    cond2 = (number_detected_drops >= filter_ni)
+    qc[cond2] = 0.
+    # Set values to 0 where condition 3 is True
+    cond3 = (number_detected_drops == 0)
+    qc[cond3] = 0.
+
+    return qc
+
+
+def get_qc_time_interval(interval, integration_time):
+
+    # if time insterval is longer than integration_time the data will be considered bad
+    return np.where(interval > integration_time, 1, 0)
+
+
+# variables returned by get_batch_variables_rd80 (besides qc_time_interval)
+RD80_VARIABLES = [
+    "num_drop",
+    "number_detected_drops",
+    "diam_max",
+    "diam_min",
+    "num_drop_density",
+    "rain_rate",
+    "radar_reflectivity",
+    "liq_water",
+    "energy_flux",
+    "slope_parameter",
+    "distribution_intercept",
+    "qc_number_detected_particles",
+]
+
+
+def get_batch_variables_rd80(data, variables_info, instrument):
+
+    # all the variables derived from the counts (and the quality control flags) for the data of
+    # any span (a day, a block of days or the whole archive) in one vectorized call,
+    # the variables of each day are slices of the result (see slice_variables)
+    drop_sizes = data[variables_info["drop_col"]].to_numpy()
+    interval = data["Interval"].to_numpy()
+
+    variables = {"num_drop": drop_sizes}
+    variables.update(get_variables_rd80(drop_sizes, interval, instrument))
+    variables["qc_number_detected_particles"] = get_qc_number_detected_particles(
+        variables["number_detected_drops"],
+        variables_info["filter_ni"]
+    )
+    variables["qc_time_interval"] = get_qc_time_interval(interval, variables_info["integration_time"])
+
+    return variables
+
+
+def slice_variables(variables, start, stop):
+
+    # variables of the times start:stop (views of the arrays)
+    return {var: values[start:stop] for var, values in variables.items()}
@@ -1,14 +1,22 @@
 import datetime
-from datetime import timedelta
+from collections import deque
+import multiprocessing.util
+import os
+import pathlib
+import traceback
+from netCDF4 import Dataset
 import numpy as np
 import plotly.graph_objects as go
+import plotly.io as pio
+import utils.pool_utils as pool_utils
 
 
 def figures_to_html(figs, filename="dashboard.html"):
     dashboard = open(filename, "w")
     dashboard.write("<html><head></head><body>" + "\n")
-    for fig in figs:
-        inner_html = fig.to_html().split("<body>")[1].split("</body>")[0]
+    for i, fig in enumerate(figs):
+        # plotly.js is loaded once (from the CDN, as the html of gen_fig_1D) for all figures
+        inner_html = fig.to_html(include_plotlyjs="cdn" if i == 0 else False).split("<body>")[1].split("</body>")[0]
         dashboard.write(inner_html)
     dashboard.write("</body></html>" + "\n")
 
@@ -73,12 +81,11 @@ def gen_fig_NDropxDi(time_index, data1, index2, data2, fig_metadata, output_fold
 
     fig1 = go.Figure(layout=layout1)
 
-    data_nan1 = np.where(np.isnan(data1), None, data1)
-
+    # the missing values (NaN) are gaps of the line
     fig1.add_trace(
         go.Scatter(
             x=time_index,
-            y=data_nan1[:],
+            y=data1,
         )
     )
 
@@ -107,43 +114,31 @@ def gen_fig_NDropxDi(time_index, data1, index2, data2, fig_metadata, output_fold
 
     fig2 = go.Figure(layout=layout2)
 
-    data_nan2 = np.where(np.isnan(data2), None, data2)
-
-    # Add traces, one for each slider step
-    for sec in np.arange(0, 1440, 1):
-        fig2.add_trace(
-            go.Scatter(
-                visible=False,
-                name="({})".format(
-                    (time_index[0] + timedelta(minutes=int(sec))).strftime("%H:%M")
-                ),
-                x=index2,
-                y=data_nan2[sec][:],
-            ),
-        )
-
-    # Make 10th trace visible
-    fig2.data[0].visible = True
+    # Add a single trace with the first time of the data
+    fig2.add_trace(
+        go.Scatter(
+            x=index2,
+            y=data2[0],
+        ),
+    )
 
-    # Create and add slider
+    # Create and add slider, one step for each time of the data: each step replaces
+    # the y values of the trace with the N(D) of its time (labels HH:MM of the datetime64 index)
+    labels = np.datetime_as_string(time_index, unit="m")
     steps = []
-    for i in range(len(fig2.data)):
-        label_aux = time_index[0] + timedelta(minutes=i)
+    for i in range(data2.shape[0]):
         step = dict(
-            method="update",
-            label=label_aux.strftime("%H:%M"),
-            args=[
-                {"visible": [False] * len(fig2.data)},
-            ],  # layout attribute
+            method="restyle",
+            label=labels[i][-5:],
+            args=[{"y": [data2[i]]}, [0]],
         )
-        step["args"][0]["visible"][i] = True  # Toggle i'th trace to "visible"
         steps.append(step)
 
     sliders = [
         dict(
             active=0,
             currentvalue={
-                "prefix": "{} - Time: ".format(time_index[0].strftime("%b %d,%Y"))
+                "prefix": "{} - Time: ".format(time_index[0].astype(datetime.datetime).strftime("%b %d,%Y"))
             },
             # pad={"t": 50},
             steps=steps,
@@ -166,7 +161,7 @@ def gen_fig_NDropxDi(time_index, data1, index2, data2, fig_metadata, output_fold
     figures_to_html([fig1, fig2], filename=output_folder.joinpath(html_filename))
 
 
-def gen_fig_1D(data, index, var, unit, fig_metadata, output_folder, flag_png):
+def gen_fig_1D(data, index, var, unit, fig_metadata, output_folder, flag_png, png_exporter=None):
 
     layout = go.Layout(autosize=False, width=1000, height=450)
 
@@ -228,11 +223,8 @@ def gen_fig_1D(data, index, var, unit, fig_metadata, output_folder, flag_png):
     # add title
     # fig.update_layout(title="JOSS - {} ({})".format(var, unit))
 
-    # Convert missing values to None
-    data_nan = np.where(np.isnan(data), None, data)
-
-    # add data trace
-    fig.add_trace(go.Scatter(x=index, y=data_nan, mode="lines"))
+    # add data trace, the missing values (NaN) are gaps of the line
+    fig.add_trace(go.Scatter(x=index, y=data, mode="lines"))
 
     # update axes
     fig.update_xaxes(nticks=24)
@@ -247,6 +239,263 @@ def gen_fig_1D(data, index, var, unit, fig_metadata, output_folder, flag_png):
     )
 
     # export figures as files
-    fig.write_image(output_folder.joinpath(png_filename))
+    # with png_exporter the PNG file is exported in its thread, the Future of the file is returned
+    if png_exporter is None:
+        fig.write_image(output_folder.joinpath(png_filename))
+        future = None
+    else:
+        future = png_exporter.put(fig, output_folder.joinpath(png_filename))
     if not flag_png:
         fig.write_html(output_folder.joinpath(html_filename), include_plotlyjs="cdn")
+
+    return future
+
+
+def read_figure_data(file_data, variables):
+
+    # time index (datetime64, UTC) and the variables of an open netCDF file as float arrays with NaN
+    # where the values are missing, they are passed as they are to the figures
+    file_data.set_auto_mask(False)
+    time_values = file_data["base_time"][...] + file_data["time_offset"][:]
+    time_index = np.round(time_values * 1e6).astype(np.int64).astype("datetime64[us]")
+
+    data = {}
+    for var in variables:
+        values = file_data[var][:]
+        data[var] = np.where(values == file_data[var].missing_value, np.nan, values)
+
+    return time_index, data
+
+
+def gen_file_figures(file, variables_info, netCDF_info, path_output_fig, flag_png, png_exporter=None):
+
+    # the figures of one netCDF file (folder path_output_fig/<file name>), returns the Futures of
+    # the PNG files exported by png_exporter
+    print("Generating figures for file {}".format(file.name))
+    output_folder = path_output_fig.joinpath(str(file.name)[:-3])
+    pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
+    futures = []
+
+    fig_metadata = {"disdrometer": "RD-80", "site": "Atto-Campina"}
+
+    list_variables_1D = ["rain_rate", "radar_reflectivity", "liq_water"]
+
+    with Dataset(file, "r") as file_data:
+        time_index, data = read_figure_data(file_data, list_variables_1D + ["num_drop_density"])
+
+    for var in list_variables_1D:
+        print("\tFigure for variable {}".format(var))
+        futures.append(gen_fig_1D(
+            data[var],
+            time_index,
+            netCDF_info["variables"][var]["short_name"],
+            netCDF_info["variables"][var]["units"],
+            fig_metadata,
+            output_folder,
+            flag_png,
+            png_exporter,
+        ))
+
+    if not flag_png:
+        print("\tFigure for variable {}".format("Rain Rate and NDropxDi"))
+        gen_fig_NDropxDi(
+            time_index,
+            data["rain_rate"],
+            variables_info["drop_mean_diam"],
+            data["num_drop_density"],
+            fig_metadata,
+            output_folder,
+        )
+
+    return [future for future in futures if future is not None]
+
+
+def get_file_error(error, futures):
+
+    # traceback of the figures of a file that failed (None if all were generated), waits for its PNG files
+    errors = [error] if error is not None else []
+    errors += ["".join(traceback.format_exception(future.exception())) for future in futures if future.exception() is not None]
+    return "".join(errors) if len(errors) > 0 else None
+
+
+def init_file_worker(context):
+
+    # the PngExporter (renderer) of a worker process, started once per worker and closed when the worker
+    # exits (the pool stops its workers without calling atexit)
+    png_exporter = PngExporter(context.pop("png_backend"))
+    multiprocessing.util.Finalize(None, png_exporter.close, exitpriority=0)
+    context["png_exporter"] = png_exporter
+
+
+def run_file_worker(file, png_exporter, **context):
+
+    # the worker waits for the PNG files of the file, so their errors are returned with it, and returns the
+    # counters of its PngExporter (key: pid of the worker) for the stats of the PNG export
+    futures = gen_file_figures(file, png_exporter=png_exporter, **context)
+    return get_file_error(None, futures), (os.getpid(), png_exporter.get_stats())
+
+
+def generate_files_figures(files, variables_info, netCDF_info, path_output_fig, flag_png, png_backend="kaleido", workers=None):
+
+    # generate the figures of the netCDF files and yield, in the order of the files, (file, log, error).
+    # A file that fails (or one of its PNG files) has the traceback in error, the other files are still
+    # generated. Serially the PNG files are exported by one PngExporter while the next files are read. With
+    # a process pool each worker has its own PngExporter and at most 2 * workers files are in flight
+    context = dict(
+        variables_info=variables_info,
+        netCDF_info=netCDF_info,
+        path_output_fig=path_output_fig,
+        flag_png=flag_png,
+    )
+
+    if workers is None or workers <= 1:
+        png_exporter = PngExporter(png_backend)
+        pending = deque()
+        try:
+            for file in files:
+                futures, log, error = pool_utils.run_logged(gen_file_figures, file, png_exporter=png_exporter, **context)
+                pending.append((file, log, error, futures or []))
+                # the files whose PNG files are already exported
+                while pending and all(future.done() for future in pending[0][3]):
+                    file, log, error, futures = pending.popleft()
+                    yield file, log, get_file_error(error, futures)
+            while pending:
+                file, log, error, futures = pending.popleft()
+                yield file, log, get_file_error(error, futures)
+        finally:
+            png_exporter.close()
+            png_exporter.print_stats()
+        return
+
+    context["png_backend"] = png_backend
+    files = ((file,) for file in files)
+    worker_stats = {}
+    try:
+        for (file,), result, log, error in pool_utils.imap_ordered(run_file_worker, files, context, workers, setup=init_file_worker):
+            if result is not None:
+                error, (pid, stats) = result
+                worker_stats[pid] = stats
+            yield file, log, error
+    finally:
+        if len(worker_stats) > 0:
+            print_png_stats(png_backend, list(worker_stats.values()))
+
+
+# EXPORT OF THE PNG FILES
+
+PNG_BACKENDS = ["kaleido", "matplotlib"]
+
+
+class PngExporter(pool_utils.ThreadWorker):
+
+    # dedicated thread exporting the PNG files of the figures, so the next figures are built while a figure
+    # is rendered (see pool_utils.ThreadWorker). backend "kaleido": one kaleido (chromium) process for the
+    # whole run, started with the thread (the first figure does not wait for it), the figures are the same
+    # as with fig.write_image. backend "matplotlib": quicklook of the figure drawn with matplotlib (Agg),
+    # with the same size, annotations and axes, without chromium. put returns the Future of the file
+    def __init__(self, backend="kaleido", max_queue=8):
+        self.backend = backend
+        super().__init__(max_queue)
+
+    def put(self, fig, png_filename):
+        return super().put(fig.to_dict(), png_filename)
+
+    def setup(self):
+        # start the kaleido process with an empty figure (or import matplotlib)
+        if self.backend == "kaleido":
+            pio.kaleido.scope.transform(go.Figure().to_dict(), format="png")
+        else:
+            import matplotlib.backends.backend_agg
+
+    def work(self, fig_dict, png_filename):
+        if self.backend == "kaleido":
+            with open(png_filename, "wb") as xfile:
+                xfile.write(pio.kaleido.scope.transform(fig_dict, format="png"))
+        else:
+            write_image_matplotlib(fig_dict, png_filename)
+        return png_filename
+
+    def print_stats(self):
+        print_png_stats(self.backend, [self.get_stats()])
+
+
+def print_png_stats(backend, stats):
+
+    # stats: counters of the PngExporter of each process (see pool_utils.ThreadWorker.get_stats), the times
+    # of the processes are summed
+    total = {name: sum(item[name] for item in stats) for name in stats[0]}
+    if len(stats) > 1:
+        backend = "{}, {} processes".format(backend, len(stats))
+    print("PNG export ({}): {} figures in {:.2f} s ({:.0f} ms per figure), {:.2f} s to start the renderer, the figures waited {:.2f} s for the exporter (queue full)".format(
+        backend, total["count"], total["work_time"], 1000 * total["work_time"] / max(total["count"], 1), total["start_time"], total["wait_put"]))
+
+
+def write_image_matplotlib(fig_dict, png_filename):
+
+    # quicklook of a plotly figure (dict of fig.to_dict()) with matplotlib: scatter traces, annotations
+    # in paper coordinates, axis titles and types, size and top margin of the layout (in pixels)
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib import dates as mdates, ticker, transforms
+
+    layout = fig_dict["layout"]
+    dpi = 100
+    points = 72 / dpi
+    width, height = layout.get("width", 700), layout.get("height", 450)
+    margin = {"l": 80, "r": 80, "t": 100, "b": 80}
+    margin.update(layout.get("margin", {}))
+
+    fig = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    FigureCanvasAgg(fig)
+    fig.subplots_adjust(
+        left=margin["l"] / width,
+        right=1 - margin["r"] / width,
+        bottom=margin["b"] / height,
+        top=1 - margin["t"] / height,
+    )
+    ax = fig.add_subplot()
+    ax.set_facecolor("#E5ECF6")
+    ax.grid(color="white")
+    ax.set_axisbelow(True)
+    for side in ax.spines.values():
+        side.set_visible(False)
+
+    for trace in fig_dict["data"]:
+        y = np.asarray(trace["y"], dtype=float)
+        x = trace.get("x", np.arange(len(y)))
+        ax.plot(x, y, color="#636efa", linewidth=1.5)
+    ax.margins(x=0)
+
+    for axis, name, set_scale in [(ax.xaxis, "xaxis", ax.set_xscale), (ax.yaxis, "yaxis", ax.set_yscale)]:
+        axis_layout = layout.get(name, {})
+        title = axis_layout.get("title", {}).get("text")
+        if title:
+            axis.set_label_text(title, fontsize=14 * points)
+        if axis_layout.get("type") == "log":
+            set_scale("log")
+        if axis_layout.get("nticks") and isinstance(axis.get_major_locator(), mdates.AutoDateLocator):
+            axis.set_major_locator(mdates.AutoDateLocator(maxticks=axis_layout["nticks"]))
+            axis.set_major_formatter(mdates.DateFormatter("%H:%M"))
+            # plotly rotates the labels when they do not fit
+            axis.set_tick_params(rotation=90)
+        elif axis_layout.get("nticks"):
+            axis.set_major_locator(ticker.MaxNLocator(axis_layout["nticks"]))
+    ax.tick_params(labelsize=12 * points)
+
+    for note in layout.get("annotations", []):
+        # the anchor "auto" of plotly is the top above 2/3 of the plot and the left at its left side
+        # (the annotations of the figures are at x=0)
+        position = transforms.offset_copy(ax.transAxes, fig=fig, x=note.get("xshift", 0), y=note.get("yshift", 0), units="dots")
+        ax.text(
+            note["x"],
+            note["y"],
+            note["text"].replace("<br>", "\n").strip(),
+            transform=position,
+            fontsize=note.get("font", {}).get("size", 12) * points,
+            ha="left",
+            va="top" if note["y"] > 2 / 3 else "bottom",
+            multialignment="left",
+            clip_on=False,
+        )
+
+    fig.savefig(png_filename, dpi=dpi)
@@ -0,0 +1,220 @@
+import bisect
+import hashlib
+import itertools
+import json
+import pathlib
+from datetime import datetime
+import pandas as pd
+import utils.disdrometer_utils as disd
+from utils.store_utils import JsonStore, get_file_entry, get_file_hash, is_same_file
+
+
+def get_config_hash(files, options=()):
+
+    # hash of the files that change the output (json files of the site and source code of the scripts)
+    # and of the options of the run (e.g. format and compression level)
+    sha1 = hashlib.sha1()
+    for file in files:
+        sha1.update(get_file_hash(file).encode())
+    sha1.update(json.dumps([str(option) for option in options]).encode())
+    return sha1.hexdigest()
+
+
+def get_rows_hash(rows):
+
+    # hash of the rows (index and values) of a dataframe
+    return hashlib.sha1(pd.util.hash_pandas_object(rows, index=True).to_numpy().tobytes()).hexdigest()
+
+
+def get_day_fingerprint(rows, config_hash):
+
+    # fingerprint of a daily output: the input rows of the day and the configuration used to process them
+    return hashlib.sha1((get_rows_hash(rows) + config_hash).encode()).hexdigest()
+
+
+# Manifest of the daily output files (manifest.json in the output folder): the fingerprint of each file
+# when it was generated and the size and mtime of the file written. A day whose fingerprint did not change
+# does not need to be generated again, if its file is still the one written (a run without the manifest,
+# e.g. with another format, rewrites the files and they are generated again).
+class OutputManifest(JsonStore):
+
+    MANIFEST_FILE = "manifest.json"
+
+    def __init__(self, path_output_data):
+        self.path_output_data = pathlib.Path(path_output_data)
+        super().__init__(
+            self.path_output_data.joinpath(self.MANIFEST_FILE),
+            "The manifest of the output files is corrupted, all days will be generated",
+        )
+
+    def is_unchanged(self, filename, fingerprint):
+        entry = self.entries.get(filename)
+        if not isinstance(entry, dict) or entry.get("fingerprint") != fingerprint:
+            return False
+        return is_same_file(entry, self.path_output_data.joinpath(filename))
+
+    def update(self, filename, fingerprint):
+        # called when the file is written
+        self.entries[filename] = get_file_entry(self.path_output_data.joinpath(filename), with_hash=False)
+        self.entries[filename]["fingerprint"] = fingerprint
+
+
+# Manifest of the figures (manifest.json in the figures folder): for each netCDF file, its size, mtime and
+# content hash, the hash of the figure options and code and the size and mtime of each figure of its folder
+# when its figures were generated. The figures of a file whose content and configuration did not change and
+# whose figures are still the ones written are not generated again. A file with a new mtime but the same
+# content is unchanged
+class FigureManifest(JsonStore):
+
+    MANIFEST_FILE = "manifest.json"
+
+    def __init__(self, path_output_fig):
+        self.path_output_fig = pathlib.Path(path_output_fig)
+        super().__init__(
+            self.path_output_fig.joinpath(self.MANIFEST_FILE),
+            "The manifest of the figures is corrupted, all figures will be generated",
+        )
+
+    def is_unchanged(self, file, config_hash):
+        entry = self.entries.get(pathlib.Path(file).name)
+        if not isinstance(entry, dict) or entry.get("config") != config_hash or "figures" not in entry:
+            return False
+        output_folder = self.path_output_fig.joinpath(pathlib.Path(file).stem)
+        if not output_folder.is_dir():
+            return False
+        if not all(is_same_file(figure, output_folder.joinpath(name)) for name, figure in entry["figures"].items()):
+            return False
+        return is_same_file(entry, file)
+
+    def update(self, file, config_hash):
+        # called when the figures of the file are written
+        output_folder = self.path_output_fig.joinpath(pathlib.Path(file).stem)
+        entry = get_file_entry(file)
+        entry["config"] = config_hash
+        entry["figures"] = {
+            figure.name: get_file_entry(figure, with_hash=False)
+            for figure in sorted(output_folder.iterdir())
+            if figure.is_file()
+        }
+        self.entries[pathlib.Path(file).name] = entry
+
+
+# State of the input files for the incremental mode (incremental_state.json in the input folder): the size,
+# mtime, content hash and time range (first and last datestamps) of each file when its days were
+# generated. The days covered by the new, changed or deleted files are the ones to generate again.
+class InputState(JsonStore):
+
+    STATE_FILE = "incremental_state.json"
+
+    def __init__(self, path_input):
+        super().__init__(
+            pathlib.Path(path_input).joinpath(self.STATE_FILE),
+            "The state of the incremental mode is corrupted, all files will be processed",
+        )
+
+    @staticmethod
+    def get_key(file):
+        return str(pathlib.Path(file).resolve())
+
+    def is_changed(self, file):
+        entry = self.entries.get(self.get_key(file))
+        return entry is None or not is_same_file(entry, file)
+
+    def get_removed(self):
+        # the files of the state that do not exist anymore
+        return [key for key in self.entries if not pathlib.Path(key).exists()]
+
+    def get_range(self, key):
+        # time range of a file of the state, (None, None) if it has no data
+        entry = self.entries[key]
+        if entry["first"] is None:
+            return None, None
+        return datetime.fromisoformat(entry["first"]), datetime.fromisoformat(entry["last"])
+
+    def update(self, file, first, last):
+        entry = get_file_entry(file)
+        entry["first"] = first.isoformat() if first is not None else None
+        entry["last"] = last.isoformat() if last is not None else None
+        self.entries[self.get_key(file)] = entry
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+
+# Index of the time range (first and last datestamps) of each input file (time_index.json in the input
+# folder). The range of a file is read from its first and last lines only and read again when the size or
+# the mtime of the file changes. Used to read only the files that overlap the date requested.
+class FileTimeIndex(JsonStore):
+
+    INDEX_FILE = "time_index.json"
+
+    def __init__(self, path_input):
+        super().__init__(
+            pathlib.Path(path_input).joinpath(self.INDEX_FILE),
+            "The time index of the input files is corrupted, it will be built again",
+        )
+
+    def get_range(self, file):
+        # time range of the file, (None, None) if it has no data
+        key = str(pathlib.Path(file).resolve())
+        entry = self.entries.get(key)
+        if entry is None or not is_same_file(entry, file):
+            first, last = disd.get_time_range_rd80(file)
+            entry = get_file_entry(file, with_hash=False)
+            entry["first"] = first.isoformat() if first is not None else None
+            entry["last"] = last.isoformat() if last is not None else None
+            self.entries[key] = entry
+        if entry["first"] is None:
+            return None, None
+        return datetime.fromisoformat(entry["first"]), datetime.fromisoformat(entry["last"])
+
+    def select_files(self, files, start, end):
+        # the files with data between start (inclusive) and end (exclusive), in reading order (first datestamp,
+        # then name, as disd.sort_files_rd80). If there is none, the first file after end, so the days before it
+        # are still generated as days without data. Every file with a row of the day is selected, so the rows
+        # kept for the duplicated datestamps are the same as reading all the files
+        ranges = sorted(
+            (first, str(file), last, file)
+            for file, (first, last) in ((file, self.get_range(file)) for file in files)
+            if first is not None
+        )
+        selected = [file for first, _, last, file in ranges if first < end and last >= start]
+        if len(selected) == 0:
+            selected = [file for first, _, last, file in ranges if first >= end][:1]
+        return selected
+
+    def save(self):
+        # the files that do not exist anymore are removed from the index
+        self.entries = {key: entry for key, entry in self.entries.items() if pathlib.Path(key).exists()}
+        super().save()
+
+
+def get_range_days(first, last):
+
+    # the days (midnight datestamps) from first to last
+    if first is None:
+        return []
+    return list(pd.date_range(pd.Timestamp(first).floor("D"), pd.Timestamp(last).floor("D"), freq="D"))
+
+
+def get_touched_days(file_ranges, changed, old_ranges):
+
+    # days to generate again in the incremental mode. file_ranges: time range of each current file,
+    # changed: the new or changed files, old_ranges: previous time ranges of the changed and deleted files.
+    # The days of a changed file start at the last day of the file before it, so the days of an outage
+    # before the file are generated too (days without data)
+    touched = set()
+    for first, last in old_ranges:
+        touched.update(get_range_days(first, last))
+
+    ranges = sorted(file_range for file_range in file_ranges.values() if file_range[0] is not None)
+    firsts = [first for first, last in ranges]
+    max_lasts = list(itertools.accumulate((last for first, last in ranges), max))
+    for file in changed:
+        first, last = file_ranges[file]
+        if first is None:
+            continue
+        i = bisect.bisect_left(firsts, first)
+        touched.update(get_range_days(max_lasts[i - 1] if i > 0 else first, last))
+
+    return touched
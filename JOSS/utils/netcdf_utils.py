@@ -1,18 +1,41 @@
 from datetime import datetime
-import xarray as xr
+import contextlib
+from collections import deque
+import io
+import tempfile
+import time
+import traceback
+import netCDF4
 import numpy as np
 import os
 import utils.disdrometer_utils as disd
+import utils.pool_utils as pool_utils
 import pathlib
 
 
 def extract_variables(
     day_data,
     variables_info,
-    netCDF_info
+    netCDF_info,
+    instrument=None,
+    day_variables=None,
+    plan=None
 ):
     print("Extracting variables from the data")
 
+    # constant vectors of the raindrop classes (build it once with disd.Instrument and pass it for many days)
+    if instrument is None:
+        instrument = disd.Instrument(variables_info)
+
+    # compiled netCDF_info (build it once with WritePlan and pass it for many days)
+    if plan is None:
+        plan = WritePlan(netCDF_info)
+
+    # variables derived from the counts, day_variables is given when they were calculated for many
+    # days at once (see disd.iter_day_variables)
+    if day_variables is None:
+        day_variables = disd.get_batch_variables_rd80(day_data, variables_info, instrument)
+
     #defining the dimensions and variables of the netCDF file:
     #    "time": "It is always a daily file, please, check the integration_time in variable_info.json",
     #    "drop_avg_class": "check the variable_info.json"
@@ -26,16 +49,8 @@ def extract_variables(
     dimensions["time"] = ref_time
     dimensions["drop_avg_class"] = np.array(variables_info["drop_mean_diam"])
 
-    #creating and filling the variables that already have values in the jason file "variables":
-    for key in netCDF_info.keys():
-        if 'variables' in key:
-            for var in netCDF_info[key].keys():
-                #check if the variable is optional (False means that the variable is not mandatory):
-                if netCDF_info[key][var]['optional'] is True:
-                    #checking if the variable has value in the data:
-                    #if netCDF_info[key][var]['value'] is not None:
-                        #filling the variable with the data:
-                    variables[var] = netCDF_info[key][var]['value']
+    #filling the variables that already have values in the json file "variables":
+    variables.update(plan.constants)
 
     #creating and filling variables manually:
     variables["base_time"] = basetime
@@ -46,112 +61,13 @@ def extract_variables(
     variables["drop_avg_class"] = np.array(dimensions["drop_avg_class"])
     variables["fall_velocity"] = np.array(variables_info["fall_vell"])
     variables["delta_diam"] = np.array(variables_info["delta_diam"])
-    variables["num_drop"] = day_data[variables_info["drop_col"]].to_numpy()
-    #total number of drops detected in num_drop:
-    variables['number_detected_drops'] = np.array(variables["num_drop"].sum(axis=1))
-    variables['diam_max'] = np.array(
-        disd.get_d_max(
-            variables["num_drop"],
-            variables_info["drop_mean_diam"]
-        )
-    )
-    variables['diam_min'] = np.array(
-        disd.get_d_min(
-            variables["num_drop"],
-            variables_info["drop_mean_diam"]
-        )
-    )
-
-    time_interval = day_data['Interval'].to_numpy()
-
-    variables['num_drop_density'] = np.array(
-        disd.get_n_d_rd80(
-            variables["num_drop"],
-            time_interval,
-            variables_info["delta_diam"],
-            variables_info["fall_vell"]
-        )
-    )
-    variables['rain_rate'] = np.array(
-        disd.get_ri_rd80(
-            variables["num_drop"],
-            time_interval,
-            variables_info["drop_mean_diam"],
-            variables_info["sensor_area"]
-        )
-    )
-    variables['radar_reflectivity'] = np.array(
-        disd.get_zdb(
-            disd.get_z_rd80(
-                variables["num_drop"],
-                time_interval,
-                variables_info["drop_mean_diam"],
-                variables_info["fall_vell"],
-                variables_info["sensor_area"]
-            )
-        )
-    )
-    variables['liq_water'] = np.array(
-        disd.get_liq_water_rd80(
-            variables["num_drop"],
-            time_interval,
-            variables_info["drop_mean_diam"],
-            variables_info["fall_vell"],
-            variables_info["sensor_area"]
-        )
-    )
-    variables['energy_flux'] = np.array(
-        disd.get_ef(
-            disd.get_ek_rd80(
-                variables["num_drop"],
-                variables_info["drop_mean_diam"],
-                variables_info["fall_vell"],
-                variables_info["sensor_area"]
-            ),
-            time_interval
-        )
-    )
-    variables['slope_parameter'] = np.array(
-        disd.get_slope(
-            variables["liq_water"], 
-            disd.get_z_rd80(
-                variables["num_drop"],
-                time_interval,
-                variables_info["drop_mean_diam"],
-                variables_info["fall_vell"],
-                variables_info["sensor_area"]
-            )
-        )
-    )
-    variables['distribution_intercept'] = np.array(
-        disd.get_n_0(
-            variables["liq_water"],
-            disd.get_z_rd80(
-                variables["num_drop"],
-                time_interval,
-                variables_info["drop_mean_diam"],
-                variables_info["fall_vell"],
-                variables_info["sensor_area"]
-            ),
-        )
-    )
 
-    # ##################### Quality control variables: #####################
+    #num_drop, total number of drops detected in num_drop, the variables derived from the drop size
+    #distribution and the quality control variables:
     # (1) - qc_number_detected_particles: 0 = good data, 1 = bad data
-    variables['qc_number_detected_particles'] = np.array(variables['number_detected_drops'])
-
-    # Set values to 1 where condition 1 is True
-    cond1 = (variables['number_detected_drops'] > 0) & (variables['number_detected_drops'] < variables_info["filter_ni"])
-    variables['qc_number_detected_particles'][cond1] = 1.
-    # Set values to 0 where condition 2 is True
-    cond2 = (variables['number_detected_drops'] >= variables_info["filter_ni"])
-    variables['qc_number_detected_particles'][cond2] = 0.
-    # Set values to 0 where condition 3 is True
-    cond3 = (variables['number_detected_drops'] == 0)
-    variables['qc_number_detected_particles'][cond3] = 0.
-
     # (2) - QC for time_interval: if time insterval is longer than integration_time the data will be considered bad
-    qc_time_interval = np.where(time_interval > variables_info["integration_time"], 1, 0)
+    variables.update(day_variables)
+    qc_time_interval = variables.pop('qc_time_interval')
     if np.max(qc_time_interval) == 1:
         print("WARNING: The time interval is longer than the integration time")
         print("The data will be considered bad")
@@ -159,128 +75,527 @@ def extract_variables(
     
     # ##################### Checking if the variables are correct: #####################
     #checking if has a missing variables or wrong dimensions between the variables in the json file and the variables that were created manually:
-    for key in netCDF_info.keys():
-        if 'variables' in key:
-            for var in netCDF_info[key].keys():
-                if netCDF_info[key][var]['optional'] is True:
-                    if var not in variables.keys():
-                        print("EXIT: The variable", var, "is mandatory, but it was not found in the data")
-                        print("Please, check your variables in the json file and in the code")
-                        exit()
-                    #checking if the variable has the same dimension as the one in the json file:
-                    if netCDF_info[key][var]['dimensions'] is not None:
-                        i=0
-                        for dim in netCDF_info[key][var]['dimensions']:
-                            if dim in dimensions.keys():
-                                if len(dimensions[dim]) != variables[var].shape[i]:
-                                    print("EXIT: The variable", var, "has a different dimension than the one in the json file")
-                                    print("Please, check your variables in the json file and in the code")
-                                    exit()
-                            i+=1
-                        
+    plan.check_variables(dimensions, variables)
 
     return dimensions, variables
 
+
+# Variables created by extract_variables, the other mandatory variables of netCDF_info_ARM.json need a value
+COMPUTED_VARIABLES = ["base_time", "time_offset", "time", "drop_avg_class", "fall_velocity", "delta_diam"] + disd.RD80_VARIABLES
+
+# Variables without valid_min/valid_max calculated from the data
+NO_VALID_RANGE_VARIABLES = ["base_time", "time_offset", "time", "lat", "lon", "alt", "drop_avg_class"]
+
+
+class WritePlan:
+
+    # netCDF_info_ARM.json compiled once per run: the order, numpy datatype, dimensions, typed missing
+    # value and attributes of each variable, the global attributes and the netCDF format. The json file is
+    # validated when the plan is built (before any day is processed) and each day only fills the data
+    def __init__(self, netCDF_info, nc_format="NETCDF3_CLASSIC", complevel=4, shuffle=True):
+        self.nc_format = nc_format
+        self.complevel = complevel
+        self.shuffle = shuffle
+
+        variables_info_nc = netCDF_info.get('variables', {})
+        for var in ['base_time', 'time_offset', 'time']:
+            if var not in variables_info_nc:
+                print("EXIT: The variable", var, "was not found in the json file")
+                exit()
+
+        self.global_attributes = {attr: attr_value['long_name'] for attr, attr_value in netCDF_info.get('global attributes', {}).items()}
+        try:
+            self.integration_time = int(netCDF_info['global attributes']['sampling_interval']['value'])
+        except (KeyError, TypeError, ValueError):
+            print("EXIT: The global attribute sampling_interval has no valid value in the json file")
+            exit()
+
+        # dimensions of the variables (time is unlimited)
+        self.dimensions = list(netCDF_info.get('dimensions', {}))
+
+        # Variables order: base_time, time_offset, time, the dimensions and the other variables of the json file
+        first = ['base_time', 'time_offset', 'time']
+        order = first + [var for var in self.dimensions + list(variables_info_nc) if var not in first]
+        self.order = list(dict.fromkeys(var for var in order if var in variables_info_nc))
+
+        self.constants = {}
+        self.mandatory = []
+        self.variables = {}
+        for key in self.order:
+            value = variables_info_nc[key]
+
+            #check if the variable is optional (False means that the variable is not mandatory):
+            if value.get('optional', False) is True:
+                self.mandatory.append(key)
+                self.constants[key] = value.get('value')
+
+            dimensions = value.get('dimensions', []) or []
+            for dim in dimensions:
+                if dim not in self.dimensions:
+                    print("EXIT: The variable", key, "has the dimension", dim, "that is not in the dimensions of the json file")
+                    print("Please, check your variables in the json file and in the code")
+                    exit()
+
+            try:
+                dtype = get_nc_dtype(value.get('datatype'), nc_format)
+            except TypeError:
+                print("EXIT: The variable", key, "has an invalid datatype:", value.get('datatype'))
+                exit()
+
+            if key in self.mandatory and key not in COMPUTED_VARIABLES:
+                try:
+                    np.asarray(value.get('value'), dtype=dtype)
+                except (TypeError, ValueError):
+                    print("EXIT: The variable", key, "is mandatory, but it is not calculated and its value in the json file is not valid:", value.get('value'))
+                    print("Please, check your variables in the json file and in the code")
+                    exit()
+
+            if key == 'time':
+                attrs = {attr: attr_value for attr, attr_value in value.items() if attr != 'datatype'}
+            else:
+                attrs = {attr: attr_value for attr, attr_value in value.items()
+                         if attr not in ['dimensions', 'value', 'optional', 'datatype'] and attr_value is not None}
+
+            missing_value = attrs.get('missing_value')
+            if missing_value is not None:
+                try:
+                    missing_value = (dtype or np.dtype(np.float64)).type(missing_value)
+                except (TypeError, ValueError):
+                    print("EXIT: The variable", key, "has an invalid missing_value:", missing_value)
+                    exit()
+                attrs['missing_value'] = missing_value
+
+            # boolean attributes (e.g. 'optional' of time) are not valid in NETCDF4, store them as int8 like in NETCDF3
+            attrs = {attr: np.int8(attr_value) if isinstance(attr_value, (bool, np.bool_)) else attr_value
+                     for attr, attr_value in attrs.items()}
+
+            self.variables[key] = {
+                'dtype': dtype,
+                'dimensions': dimensions,
+                'missing_value': missing_value,
+                'attrs': attrs,
+            }
+
+        # the constants are only taken from the mandatory variables (the value of the others is not used)
+        self.constants = {key: value for key, value in self.constants.items() if key not in COMPUTED_VARIABLES}
+        self.valid_range_variables = [var for var in self.order if var not in NO_VALID_RANGE_VARIABLES]
+
+        # time quality control, always calculated
+        self.variables['qc_time'] = {
+            'dtype': get_nc_dtype('int64', nc_format),
+            'dimensions': ['time'],
+            'missing_value': None,
+            'attrs': {'long_name': 'Time quality control', 'units': '0 = good data, 1 = out of integration time, 2 = no data'},
+        }
+
+    def check_variables(self, dimensions, variables):
+
+        # the mandatory variables must have been created with the dimensions of the json file
+        for var in self.mandatory:
+            if var not in variables:
+                print("EXIT: The variable", var, "is mandatory, but it was not found in the data")
+                print("Please, check your variables in the json file and in the code")
+                exit()
+            #checking if the variable has the same dimension as the one in the json file:
+            for i, dim in enumerate(self.variables[var]['dimensions']):
+                if dim in dimensions and len(dimensions[dim]) != np.shape(variables[var])[i]:
+                    print("EXIT: The variable", var, "has a different dimension than the one in the json file")
+                    print("Please, check your variables in the json file and in the code")
+                    exit()
+
+    def encoding(self, shape):
+        return get_encoding(shape, self.nc_format, self.complevel, self.shuffle)
+
+
 def generate_netCDF(
     cdf_filename,
     dimensions_nc,
     variables_nc,
     netCDF_info,
     path_output_data,
-    day_data
+    day_data,
+    nc_format="NETCDF3_CLASSIC",
+    complevel=4,
+    shuffle=True,
+    plan=None,
+    writer=None
 ):
 
     print("Generating netCDF:", cdf_filename)
 
+    # compiled netCDF_info (build it once with WritePlan and pass it for many days)
+    if plan is None:
+        plan = WritePlan(netCDF_info, nc_format, complevel, shuffle)
 
-    # check if file already exists, if true delete
+    # check if file already exists, it is replaced when the new one is complete (see write_netCDF)
     if os.path.exists(path_output_data.joinpath(cdf_filename)):
-        os.remove(path_output_data.joinpath(cdf_filename))
         print("File already exists, overwriting a new one...")
 
-    # Create a new empty dataset with dimensions based on dimensions_nc
-    ds = xr.Dataset(coords={dim: vec for dim, vec in dimensions_nc.items()})
+    pathlib.Path(path_output_data).mkdir(parents=True, exist_ok=True)
 
-    # Add metadata for dimensions
-    for dim, dim_info in netCDF_info.get('dimensions', {}).items():
-        ds[dim].attrs['long_name'] = dim
-        ds[dim].attrs['standard_name'] = dim
+    # Convert time-related attributes to datetime
+    basetime = datetime.utcfromtimestamp(int(np.asarray(variables_nc['base_time']).astype(plan.variables['base_time']['dtype'])))
+    basetime_string = basetime.strftime('%Y-%m-%d %H:%M:%S 0:00')
 
-    # Create the variables and fill them with values from variables_nc
-    for key, value in netCDF_info.get('variables', {}).items():
-        optional = value.get('optional', False) 
+    # Create the variables data (NaN values to missing values and the DATATYPE of the json file, a single cast)
+    # and attributes
+    variables = {}
+    valid_range = ValidRange()
+    for key in plan.order:
+        spec = plan.variables[key]
         var_data = variables_nc.get(key)
 
-        if var_data is None and optional:
+        if var_data is None and key in plan.mandatory:
             print("WARNING: The variable", key, "is optional, but it is empty - CHECK THE DATA")
             var_data = 0
 
-        dimensions = value.get('dimensions', [])
-        coords = {dim: dimensions_nc[dim] for dim in dimensions} if dimensions else None
+        # valid values of the variable while its data is produced (before NaN is replaced by the missing value)
+        if key in plan.valid_range_variables:
+            valid_range.update(key, var_data, spec['dtype'])
 
-        attrs = {attr: attr_value for attr, attr_value in value.items()
-                 if attr not in ['dimensions', 'value', 'optional'] and attr_value is not None}
-            
-        ds[key] = xr.DataArray(
-            data=var_data,
-            coords=coords,
-            dims=dimensions,
-            attrs=attrs
-        )
+        variables[key] = (get_nc_data(var_data, spec['dtype'], spec['missing_value']), spec['dimensions'], dict(spec['attrs']))
 
-    # Set global attributes
-    for attr, attr_value in netCDF_info.get('global attributes', {}).items():
-        ds.attrs[attr] = attr_value['long_name']
+    variables['base_time'][2]['string'] = basetime_string
+    variables['time_offset'][2]['units'] = 'seconds since '+basetime_string
+    variables['time'][2]['units'] = 'seconds since '+basetime_string  #My midnight time is equal to the basetime, if not, use the line below:
+    #variables['time'][2]['units'] = 'seconds since '+datetime.utcfromtimestamp(basetime).strftime('%Y-%m-%d 00:00:00 0:00')
 
-    # Convert time-related attributes to datetime
-    basetime = datetime.utcfromtimestamp(ds['base_time'].values.astype(netCDF_info['variables']['base_time']['datatype']))
-    basetime_string = basetime.strftime('%Y-%m-%d %H:%M:%S 0:00')
+    # Add the valid values
+    update_attr_valid_values(variables, valid_range)
+    # time quality control
+    qc_time = time_quality_control(variables['time'][0], plan.integration_time, day_data)
+    spec = plan.variables['qc_time']
+    variables['qc_time'] = (qc_time.astype(spec['dtype']), spec['dimensions'], spec['attrs'])
+
+    if writer is None:
+        write_netCDF(path_output_data.joinpath(cdf_filename), dimensions_nc, variables, plan)
+        print("netCDF created")
+    else:
+        # written by the writer thread (see NetCDFWriter)
+        writer.put(path_output_data.joinpath(cdf_filename), dimensions_nc, variables)
+
+    return valid_range
+
+
+# suffix of the files being written (name.nc.<pid>.tmp)
+TMP_SUFFIX = ".tmp"
+
+
+def write_netCDF(path_cdf, dimensions_nc, variables, plan):
+
+    # the file is written in a temporary file in the same folder, synced to the disk and renamed (atomic),
+    # a crash or a kill never leaves a truncated file or removes the previous one
+    path_cdf = pathlib.Path(path_cdf)
+    tmp_cdf = path_cdf.with_name(path_cdf.name + "." + str(os.getpid()) + TMP_SUFFIX)
+    try:
+        write_netCDF_file(tmp_cdf, dimensions_nc, variables, plan)
+        with open(tmp_cdf, "rb") as xfile:
+            os.fsync(xfile.fileno())
+        os.replace(tmp_cdf, path_cdf)
+    except BaseException:
+        tmp_cdf.unlink(missing_ok=True)
+        raise
+    sync_folder(path_cdf.parent)
+
+
+def sync_folder(path_folder):
+
+    # the rename is only durable when the folder is synced (not supported on Windows)
+    if os.name != "posix":
+        return
+    fd = os.open(path_folder, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def is_process_running(pid):
+
+    # signal 0 only checks that the process exists (on Windows os.kill terminates the process, the
+    # processes are not checked there)
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # running, owned by another user
+        return True
+    return True
+
+
+def clean_temp_files(path_output_data, max_age=3600):
+
+    # remove the temporary files left by runs that were killed while writing: the files whose writer
+    # (pid in the name, see write_netCDF) is not running anymore, or older than max_age seconds (the pid
+    # was reused, a file is written in less than a second). The files of the runs still writing are kept
+    removed = 0
+    for file in pathlib.Path(path_output_data).glob("*.nc.*" + TMP_SUFFIX):
+        pid = file.name[:-len(TMP_SUFFIX)].rsplit(".", 1)[1]
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            age = time.time() - file.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if age > max_age or not is_process_running(int(pid)):
+            file.unlink(missing_ok=True)
+            removed += 1
+    if removed > 0:
+        print("Removed", removed, "temporary files of an interrupted run")
+    return removed
+
+
+def write_netCDF_file(path_cdf, dimensions_nc, variables, plan):
+
+    #write the output file in JOSS_CDF (netCDF file), unlimited the time dimension. The format 'NETCDF3_CLASSIC'
+    #(ARM compatible) has no chunking and no compression, the NETCDF4 formats are compressed (see get_encoding).
+    #All the variables and attributes are defined before writing the data (a single define mode) and every
+    #variable is written whole, so the variables are not prefilled with _FillValue
+    with netCDF4.Dataset(path_cdf, "w", format=plan.nc_format) as nc:
+        nc.set_fill_off()
+        # Set global attributes
+        nc.setncatts(plan.global_attributes)
+
+        for dim, vec in dimensions_nc.items():
+            nc.createDimension(dim, None if dim == 'time' else len(vec))
+
+        nc_variables = {}
+        for key, (data, dimensions, attrs) in variables.items():
+            nc_variables[key] = nc.createVariable(
+                key,
+                data.dtype,
+                dimensions,
+                fill_value=np.nan if data.dtype.kind == 'f' else None,
+                **plan.encoding(data.shape)
+            )
+            nc_variables[key].setncatts(attrs)
+            nc_variables[key].set_auto_maskandscale(False)
 
-    ds['base_time'].attrs['string'] = basetime_string
-    ds['time_offset'].attrs['units'] = 'seconds since '+basetime_string
-    ds['time'].attrs = netCDF_info['variables']['time']
-    ds['time'].attrs['units'] = 'seconds since '+basetime_string  #My midnight time is equal to the basetime, if not, use the line below:
-    #ds['time'].attrs['units'] = 'seconds since '+datetime.utcfromtimestamp(basetime).strftime('%Y-%m-%d 00:00:00 0:00')
-
-    # Convert: 2)  NaN values to missing values and 2) DATATYPE to the one in the json file
-    for var in ds.variables:
-        missing_value = ds[var].attrs.get('missing_value')
-        if missing_value is not None:
-            #print("The variable", var, "has", np.count_nonzero(np.isnan(ds[var].values)), "missing values")
-            ds[var].values[np.isnan(ds[var].values)] = float(missing_value)
-        if netCDF_info['variables'][var].get('datatype') is not None:
-            ds[var] = ds[var].astype(netCDF_info['variables'][var]['datatype'])
-            ds[var].encoding['_FillValue'] = None
-            if missing_value is not None:
-                missing_value = ds[var].dtype.type(missing_value)
-                ds[var].attrs['missing_value'] = missing_value
-        ds[var].attrs.pop('datatype', None)
+        for key, (data, dimensions, attrs) in variables.items():
+            nc_variables[key][...] = data
 
-    pathlib.Path(path_output_data).mkdir(parents=True, exist_ok=True)
 
-    
-    # Add time quality control
-    ds = update_attr_valid_values(ds)
-    # time quality control
-    ds = time_quality_control(ds, netCDF_info, day_data)
-    # Move variables to the first position: base_time, time_offset, time
-    ds = ds[['base_time', 'time_offset', 'time'] + [var for var in ds.variables if var not in ['base_time', 'time_offset', 'time']]]
-    #write the output file in JOSS_CDF (netCDF file), unlimited the time dimension and delete the chunking by using the format 'NETCDF3_CLASSIC':
-    # Add max compression level
-    ds.to_netcdf(path_output_data.joinpath(cdf_filename),
-                unlimited_dims='time',
-                format='NETCDF3_CLASSIC',
-                encoding={var: {'zlib': True, 'complevel': 9} for var in ds.variables})
-    print("netCDF created")
+class NetCDFWriter(pool_utils.ThreadWorker):
+
+    # dedicated thread writing the netCDF files prepared by generate_netCDF, so the variables of the next
+    # days are calculated while a day is written (the netCDF library releases the GIL during the I/O).
+    # At most max_queue days are waiting (see pool_utils.ThreadWorker), the result of each file is also
+    # kept in futures (key: path of the file)
+    def __init__(self, plan, max_queue=2):
+        self.plan = plan
+        self.futures = {}
+        super().__init__(max_queue)
+
+    def put(self, path_cdf, dimensions_nc, variables):
+        future = super().put(path_cdf, dimensions_nc, variables)
+        self.futures[str(path_cdf)] = future
+        return future
+
+    def work(self, path_cdf, dimensions_nc, variables):
+        write_netCDF(path_cdf, dimensions_nc, variables, self.plan)
+        return path_cdf
+
+    def print_stats(self):
+        print("Pipeline: writing took {:.2f} s, the calculation waited {:.2f} s for the writer (queue full) and the writer waited {:.2f} s for the days".format(
+            self.work_time, self.wait_put, self.wait_get))
+
+
+def get_cdf_filename(netCDF_info, first_time):
+    # first_time: datestamp of the first time of the day (day_data.index[0])
+    return netCDF_info['global attributes']['datastream']['long_name']+"."+ first_time.strftime("%Y%m%d.%H%M%S")+".nc"
+
+
+def gen_day_netCDF(
+    day_data,
+    day_variables,
+    variables_info,
+    netCDF_info,
+    instrument,
+    plan,
+    path_output_data,
+    writer=None
+):
+
+    # the netCDF file of one day, returns the valid ranges of its variables (see ValidRange)
+    print("Generating netCDF file for", day_data.index[0].strftime("%d/%m/%Y"))
+    (dimension_nc,filled_variables) = extract_variables(day_data,variables_info,netCDF_info,instrument,day_variables,plan)
+
+    return generate_netCDF(
+        get_cdf_filename(netCDF_info, day_data.index[0]),
+        dimension_nc,
+        filled_variables,
+        netCDF_info,
+        path_output_data,
+        day_data['no-data'],
+        plan=plan,
+        writer=writer
+    )
+
+
+def generate_days_netCDF(
+    days,
+    variables_info,
+    netCDF_info,
+    instrument,
+    plan,
+    path_output_data,
+    workers=None,
+    pipeline=False
+):
+
+    # generate the netCDF files of the days (day_data, day_variables) and yield, in the order of the
+    # days, (day_data, valid_range, log, error). A day that fails has valid_range None and the traceback
+    # in error, the other days are still generated. With a process pool at most 2 * workers days are
+    # in flight (the days are produced only when there is room for them). With pipeline (serial) the
+    # files are written by a writer thread while the next days are calculated (see NetCDFWriter)
+    context = dict(
+        variables_info=variables_info,
+        netCDF_info=netCDF_info,
+        instrument=instrument,
+        plan=plan,
+        path_output_data=path_output_data,
+    )
+
+    if pipeline and (workers is None or workers <= 1):
+        yield from generate_days_pipeline(days, context)
+        return
+
+    if workers is None or workers <= 1:
+        for day_data, day_variables in days:
+            try:
+                valid_range = gen_day_netCDF(day_data, day_variables, **context)
+                yield day_data, valid_range, "", None
+            except (Exception, SystemExit):
+                yield day_data, None, "", traceback.format_exc()
+        return
+
+    # the messages are returned with the result, they are printed in the order of the days
+    for (day_data, _), valid_range, log, error in pool_utils.imap_ordered(gen_day_netCDF, days, context, workers):
+        yield day_data, valid_range, log, error
+
+
+def generate_days_pipeline(days, context):
+
+    # the messages of each day are kept and yielded (with "netCDF created") when its file is written,
+    # so they are printed in the order of the days like in the serial mode
+    writer = NetCDFWriter(context['plan'])
+    pending = deque()
+
+    def is_written(day):
+        return day[3] is not None or writer.futures[day[4]].done()
+
+    def resolve(day):
+        day_data, valid_range, log, error, path_cdf = day
+        if error is None:
+            future = writer.futures.pop(path_cdf)
+            if future.exception() is not None:
+                valid_range, error = None, "".join(traceback.format_exception(future.exception()))
+            else:
+                log += "netCDF created\n"
+        return day_data, valid_range, log, error
+
+    try:
+        for day_data, day_variables in days:
+            path_cdf = str(context['path_output_data'].joinpath(get_cdf_filename(context['netCDF_info'], day_data.index[0])))
+            valid_range, log, error = pool_utils.run_logged(gen_day_netCDF, day_data, day_variables, writer=writer, **context)
+            pending.append((day_data, valid_range, log, error, path_cdf))
+            # the days already written
+            while pending and is_written(pending[0]):
+                yield resolve(pending.popleft())
+        while pending:
+            yield resolve(pending.popleft())
+    finally:
+        writer.close()
+        writer.print_stats()
+
+
+def get_nc_dtype(datatype, nc_format):
+
+    # the classic data model (NETCDF3_CLASSIC and NETCDF4_CLASSIC) has no 64 bits integers, they are
+    # stored as int32 (like xarray does)
+    if datatype is None:
+        return None
+    dtype = np.dtype(datatype)
+    if nc_format != "NETCDF4" and dtype == np.int64:
+        return np.dtype(np.int32)
+    return dtype
+
+
+def get_nc_data(var_data, dtype, missing_value):
+
+    # array with the datatype of the json file, the NaN values are replaced by the missing value
+    data = np.asarray(var_data)
+    if dtype is None:
+        dtype = data.dtype
+    nan_mask = np.isnan(data) if data.dtype.kind == 'f' and missing_value is not None else None
+    data = data.astype(dtype)
+    if nan_mask is not None and nan_mask.any():
+        data[nan_mask] = missing_value
+    return data
+
+
+def get_encoding(shape, nc_format, complevel=4, shuffle=True):
+
+    # In the NETCDF4 formats the variables with dimensions are stored in a single chunk with their
+    # whole shape, a daily file is (time=1440) and (time=1440, drop_avg_class=20), and compressed
+    # (deflate level complevel and shuffle) if complevel is not 0. The scalars are not chunked
+    encoding = {}
+    if nc_format in ("NETCDF4", "NETCDF4_CLASSIC") and len(shape) > 0:
+        encoding['chunksizes'] = shape
+        if complevel:
+            encoding.update({'zlib': True, 'complevel': complevel, 'shuffle': shuffle})
+    return encoding
+
+
+def compression_report(
+    dimensions_nc,
+    variables_nc,
+    netCDF_info,
+    day_data,
+    levels=range(10)
+):
+
+    # write the same day in NETCDF3_CLASSIC and in NETCDF4_CLASSIC with each deflate level,
+    # returning a list of (format, level, size in bytes, write time in seconds)
+    report = []
+    runs = [("NETCDF3_CLASSIC", 0)] + [("NETCDF4_CLASSIC", level) for level in levels]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for nc_format, level in runs:
+            cdf_filename = "report_{}_{}.nc".format(nc_format, level)
+            plan = WritePlan(netCDF_info, nc_format, level)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                generate_netCDF(
+                    cdf_filename,
+                    dimensions_nc,
+                    variables_nc,
+                    netCDF_info,
+                    pathlib.Path(tmp_dir),
+                    day_data,
+                    plan=plan,
+                )
+            elapsed = time.perf_counter() - start
+            report.append((nc_format, level, os.path.getsize(pathlib.Path(tmp_dir).joinpath(cdf_filename)), elapsed))
+
+    return report
+
+
+def print_compression_report(report):
+
+    print("{:<16} {:>5} {:>12} {:>8} {:>10}".format("format", "level", "size (kB)", "ratio", "time (s)"))
+    reference = report[0][2]
+    for nc_format, level, size, elapsed in report:
+        print("{:<16} {:>5} {:>12.1f} {:>8.2f} {:>10.3f}".format(nc_format, level, size / 1024, size / reference, elapsed))
 
 
 # Time quality control
-def time_quality_control(ds, netCDF_info, day_data):
-    time_values = ds['time'].values.astype(int)
+def time_quality_control(time_values, integration_time, day_data):
+    time_values = time_values.astype(int)
     time_interval = np.diff(time_values)
     time_interval = np.insert(time_interval, 0, 0)
-    integration_time = netCDF_info['global attributes']['sampling_interval']['value']
-    integration_time = int(integration_time)
     integration_time = np.repeat(integration_time, len(time_interval))
     qc_time_interval = np.where(time_interval > integration_time, 1, 0)
     if np.max(qc_time_interval) == 1:
@@ -290,20 +605,59 @@ def time_quality_control(ds, netCDF_info, day_data):
     qc_no_data = np.where(day_data == 1, 2, 0)
     # qc_time is unique array mixing qc_time_interval and qc_no_data
     qc_time = np.maximum(qc_time_interval, qc_no_data)    
-    ds['qc_time'] = xr.DataArray(qc_time, coords={'time': ds['time']}, dims=['time'])
-    ds['qc_time'].attrs['long_name'] = 'Time quality control'
-    ds['qc_time'].attrs['units'] = '0 = good data, 1 = out of integration time, 2 = no data'
     
-    return ds
+    return qc_time
 
 def no_data_quality_control(ds, day_data):
 
     return ds
     
-def update_attr_valid_values(ds):
-    for var_name, var_data in ds.data_vars.items():
-            if var_name not in ["base_time", "time_offset", "time", "lat", "lon", "alt"]:
-                var_data = var_data.where(var_data != -9999)
-                ds[var_name].attrs['valid_min'] = round(var_data.min().item(),2)
-                ds[var_name].attrs['valid_max'] = round(var_data.max().item(),2)
-    return ds
\ No newline at end of file
+def update_attr_valid_values(variables, valid_range):
+    for var_name in valid_range.ranges:
+        variables[var_name][2].update(valid_range.attrs(var_name))
+    return variables
+
+
+class ValidRange:
+
+    # valid_min/valid_max of the variables, the missing values (NaN and -9999) are not valid. Each array is
+    # reduced once when it is produced (NaN is ignored by fmin/fmax, no masked copy of the data) and the
+    # ranges of many days can be merged (e.g. monthly or archive ranges from the daily ones)
+    MISSING_VALUE = -9999
+
+    def __init__(self):
+        self.ranges = {}
+
+    def update(self, var_name, var_data, dtype=None):
+        var_data = np.asarray(var_data)
+        if var_data.size == 0:
+            vmin, vmax = np.nan, np.nan
+        else:
+            vmin, vmax = np.fmin.reduce(var_data, axis=None), np.fmax.reduce(var_data, axis=None)
+            if vmin == self.MISSING_VALUE or vmax == self.MISSING_VALUE:
+                # -9999 in the data itself, only then a copy without the missing values
+                var_data = var_data[var_data != self.MISSING_VALUE]
+                if var_data.size == 0:
+                    vmin, vmax = np.nan, np.nan
+                else:
+                    vmin, vmax = np.fmin.reduce(var_data, axis=None), np.fmax.reduce(var_data, axis=None)
+        # the range of the values written in the file (datatype of the json file)
+        if dtype is not None and not np.isnan(vmin):
+            vmin, vmax = dtype.type(vmin), dtype.type(vmax)
+        self.add(var_name, float(vmin), float(vmax))
+        return self
+
+    def add(self, var_name, vmin, vmax):
+        if var_name in self.ranges:
+            vmin = float(np.fmin(self.ranges[var_name][0], vmin))
+            vmax = float(np.fmax(self.ranges[var_name][1], vmax))
+        self.ranges[var_name] = (vmin, vmax)
+
+    def merge(self, other):
+        for var_name, (vmin, vmax) in other.ranges.items():
+            self.add(var_name, vmin, vmax)
+        return self
+
+    def attrs(self, var_name):
+        vmin, vmax = self.ranges[var_name]
+        return {'valid_min': round(vmin,2), 'valid_max': round(vmax,2)}
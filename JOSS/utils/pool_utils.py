@@ -0,0 +1,135 @@
+import contextlib
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import io
+import queue
+import threading
+import time
+import traceback
+
+
+def run_logged(function, *args, **kwargs):
+
+    # run function keeping what it prints, returns (result, log, error): error is the traceback if it
+    # failed (result is None), so the messages of a day or a file are printed together and in order
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            result = function(*args, **kwargs)
+        return result, log.getvalue(), None
+    except (Exception, SystemExit):
+        return None, log.getvalue(), traceback.format_exc()
+
+
+# read-only inputs (keyword arguments) of the function of the pool in the worker processes, set once per
+# worker by init_worker
+_worker = {}
+
+
+def init_worker(context, setup):
+    _worker.update(context)
+    if setup is not None:
+        setup(_worker)
+
+
+def run_worker(function, item):
+    return run_logged(function, *item, **_worker)
+
+
+def imap_ordered(function, items, context, workers, setup=None):
+
+    # run function(*item, **context) for each item (tuple of arguments) in a process pool and yield, in the
+    # order of the items, (item, result, log, error) (see run_logged). context is sent once to each worker,
+    # where setup(context) can add the objects of the worker (e.g. a renderer). At most 2 * workers items are
+    # in flight, the items are produced only when there is room for them
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(context, setup))
+    in_flight = 2 * workers
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, executor.submit(run_worker, function, item)))
+            while len(pending) >= in_flight:
+                item, future = pending.popleft()
+                yield (item,) + future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield (item,) + future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+class ThreadWorker:
+
+    # dedicated thread running work(*args) for the items put in its queue, so the next items are prepared
+    # while an item is processed. setup() runs in the thread before the first item, if it fails all the
+    # items fail. The queue is bounded: put blocks while max_queue items are waiting (backpressure) and
+    # returns the Future of the item. The number of items is kept in count and the time of each stage in
+    # start_time (setup), wait_put (producer waiting for room in the queue), wait_get (thread waiting for
+    # an item) and work_time. The subclasses set their attributes before calling __init__ (the thread
+    # starts there)
+    def __init__(self, max_queue):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.count = 0
+        self.start_time = 0.
+        self.wait_put = 0.
+        self.wait_get = 0.
+        self.work_time = 0.
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def setup(self):
+        pass
+
+    def work(self, *args):
+        raise NotImplementedError
+
+    def put(self, *args):
+        future = Future()
+        start = time.perf_counter()
+        self.queue.put((args, future))
+        self.wait_put += time.perf_counter() - start
+        return future
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self.setup()
+            setup_error = None
+        except Exception as error:
+            setup_error = error
+        self.start_time = time.perf_counter() - start
+        while True:
+            start = time.perf_counter()
+            item = self.queue.get()
+            self.wait_get += time.perf_counter() - start
+            if item is None:
+                break
+            args, future = item
+            start = time.perf_counter()
+            try:
+                if setup_error is not None:
+                    raise setup_error
+                result, error = self.work(*args), None
+            except Exception as work_error:
+                result, error = None, work_error
+            # the counters are updated before the Future is done, so they include the items waited for
+            self.work_time += time.perf_counter() - start
+            self.count += 1
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        # wait for the items in the queue and stop the thread
+        self.queue.put(None)
+        self.thread.join()
+
+    def get_stats(self):
+        return {
+            "count": self.count,
+            "start_time": self.start_time,
+            "wait_put": self.wait_put,
+            "wait_get": self.wait_get,
+            "work_time": self.work_time,
+        }
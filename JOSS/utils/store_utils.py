@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+import pathlib
+
+
+def get_file_hash(file):
+
+    # sha1 of the content of the file, read in blocks
+    sha1 = hashlib.sha1()
+    with open(file, "rb") as xfile:
+        for block in iter(lambda: xfile.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def get_file_entry(file, with_hash=True):
+
+    # size, mtime (and content hash) of a file, recorded to know later if it changed (see is_same_file)
+    stat = os.stat(file)
+    entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if with_hash:
+        entry["hash"] = get_file_hash(file)
+    return entry
+
+
+def is_same_file(entry, file):
+
+    # True if the file is still the one recorded in entry (see get_file_entry). If the entry has the hash,
+    # a file with a new mtime (touched or copied) but the same content is the same file, the new mtime is
+    # updated in the entry
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
+        return False
+    if entry.get("size") != stat.st_size:
+        return False
+    if entry.get("mtime") != stat.st_mtime_ns:
+        if "hash" not in entry or entry["hash"] != get_file_hash(file):
+            return False
+        entry["mtime"] = stat.st_mtime_ns
+    return True
+
+
+# Dict (entries) stored in a json file: loaded when created (empty if the file does not exist, or with a
+# warning if it is corrupted) and saved in a temporary file renamed over the json file, so a killed run
+# never leaves a truncated file.
+class JsonStore:
+
+    def __init__(self, path_json, corrupted_warning):
+        self.path_json = pathlib.Path(path_json)
+        self.entries = {}
+        self.corrupted = False
+        if self.path_json.exists():
+            try:
+                with open(self.path_json, "r") as xfile:
+                    self.entries = json.load(xfile)
+            except (ValueError, OSError):
+                print("WARNING:", corrupted_warning)
+                self.corrupted = True
+
+    def save(self):
+        self.path_json.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.path_json.with_name(self.path_json.name + ".tmp")
+        with open(tmp_file, "w") as xfile:
+            json.dump(self.entries, xfile, indent=0, sort_keys=True)
+        os.replace(tmp_file, self.path_json)